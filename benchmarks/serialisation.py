@@ -0,0 +1,122 @@
+"""Compare the cost of serialising users and relationships per row.
+
+Rows are read from an in-memory SQLite database, either as Peewee model
+instances encoded with Sanic's default JSON encoder, or as raw rows encoded
+with `cupid.encoding`, as the list and graph endpoints do.
+
+Usage: python3 -m benchmarks.serialisation [<rows>]
+"""
+import sqlite3
+import sys
+import timeit
+from datetime import datetime
+from typing import Callable
+
+from cupid.encoding import ENCODER, dumps
+from cupid.models import Gender, Relationship, RelationshipKind, User, now
+
+import peewee
+
+from sanic.response import json
+
+
+# Times to repeat each measurement, taking the fastest.
+REPEATS = 5
+
+# How many rows to insert per statement, within SQLite's variable limit.
+INSERT_CHUNK_SIZE = 100
+
+
+def convert_datetime(value: bytes) -> datetime:
+    """Read a datetime stored by SQLite, as psycopg2 would return it."""
+    return datetime.fromisoformat(value.decode())
+
+
+def create_database(rows: int) -> peewee.SqliteDatabase:
+    """Create a database with `rows` users and relationships."""
+    sqlite3.register_converter('DATETIME', convert_datetime)
+    db = peewee.SqliteDatabase(
+        ':memory:', detect_types=sqlite3.PARSE_DECLTYPES,
+    )
+    db.bind([User, Relationship])
+    db.create_tables([User, Relationship])
+    timestamp = now()
+    users = [
+        {
+            'id': id,
+            'name': f'User {id}',
+            'discriminator': f'{id % 10_000:04}',
+            'avatar_url': f'https://cdn.example.com/avatars/{id}.png',
+            'gender': Gender.NON_BINARY,
+        }
+        for id in range(1, rows + 1)
+    ]
+    relationships = [
+        {
+            'initiator': id,
+            'other': id % rows + 1,
+            'kind': RelationshipKind.MARRIAGE,
+            'accepted': True,
+            'created_at': timestamp,
+            'accepted_at': timestamp,
+        }
+        for id in range(1, rows + 1)
+    ]
+    with db.atomic():
+        for model, data in ((User, users), (Relationship, relationships)):
+            for chunk in peewee.chunked(data, INSERT_CHUNK_SIZE):
+                model.insert_many(chunk).execute()
+    return db
+
+
+def models_users() -> bytes:
+    """Serialise users from model instances, the old way."""
+    return json([user.as_dict() for user in User.select()]).body
+
+
+def rows_users(db: peewee.Database) -> bytes:
+    """Serialise users from raw rows."""
+    rows = db.execute(User.select(*User.row_fields()))
+    return dumps([User.row_as_dict(row) for row in rows])
+
+
+def models_relationships() -> bytes:
+    """Serialise relationships from model instances, the old way."""
+    return json([
+        rel.as_partial_dict() for rel in Relationship.select()
+    ]).body
+
+
+def rows_relationships(db: peewee.Database) -> bytes:
+    """Serialise relationships from raw rows."""
+    rows = db.execute(Relationship.select(*Relationship.row_fields()))
+    return dumps([Relationship.row_as_partial_dict(row) for row in rows])
+
+
+def per_row(function: Callable[[], bytes], rows: int) -> float:
+    """Get the fastest time to run a function, in microseconds per row."""
+    return min(timeit.repeat(function, number=1, repeat=REPEATS)) / rows * 1e6
+
+
+def main(rows: int):
+    """Run the benchmark and print the results."""
+    db = create_database(rows)
+    print(f'{rows} rows, encoding with {ENCODER}:')
+    for name, before, after in (
+            ('users', models_users, lambda: rows_users(db)),
+            (
+                'relationships',
+                models_relationships,
+                lambda: rows_relationships(db),
+            )):
+        before_time = per_row(before, rows)
+        after_time = per_row(after, rows)
+        print(
+            f'  {name}: {before_time:.2f} us/row before, '
+            f'{after_time:.2f} us/row after '
+            f'({before_time / after_time:.1f}x faster)',
+        )
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10_000)
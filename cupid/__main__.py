@@ -11,6 +11,8 @@ Usage:
   cupid [options] create-app <name>
   cupid [options] app <name_or_id>
   cupid [options] list-apps
+  cupid [options] migrate
+  cupid [options] prune-sessions
 
 Database options:
   --db-name <name>            Name of the database to connect to ('cupid').
@@ -18,11 +20,33 @@ Database options:
   --db-password <password>    Password for the database.
   --db-host <host>            Database host ('localhost').
   --db-port <port>            Database port (5432).
+  --db-threads <count>        Threads to make database calls in (8).
+  --db-pool-min-size <count>  Connections to open on startup (1).
+  --db-pool-max-size <count>  Most connections to have open at once (20).
+  --db-pool-stale-timeout <time>
+                              Time after which idle connections are
+                                replaced ('PT5M').
+  --db-pool-timeout <time>    Time to wait for a free connection ('PT10S').
 
 Discord options:
   --discord-api-url <url>     Discord API URL ('https://discord.com/api/v8').
   --discord-cdn-url <url>     Discord CDN URL ('https://cdn.discordapp.com').
   --discord-guild-id <id>     Discord guild ID (None).
+  --discord-max-connections <count>
+                              Most connections to Discord at once (20).
+  --discord-global-rate-limit <count>
+                              Most requests to Discord per second (50).
+  --discord-max-retries <count>
+                              Times to retry a rate limited request to
+                                Discord (3).
+  --discord-keepalive-timeout <time>
+                              Time to keep idle connections to Discord open
+                                ('PT30S').
+  --discord-cache-size <count>
+                              Discord tokens to cache the user of, or 0 to
+                                disable (1024).
+  --discord-cache-ttl <time>  Time to cache a Discord token's user for
+                                ('PT1M').
 
 Logging options:
   --log-level-peewee <level>  Log level for SQL ('INFO').
@@ -37,6 +61,49 @@ Other server options:
   --disable-docs              Disable serving API docs from /docs (no).
   --config-file <path>        INI file for config options ('config.ini').
   --session-expiry <time>     User session expiry time ('PD30').
+  --session-prune-interval <time>
+                              Time between deleting expired sessions, or 0
+                                to disable ('PT1H').
+  --session-prune-batch-size <count>
+                              Most expired sessions to delete at once
+                                (1000).
+  --principal-cache-size <count>
+                              Tokens (and Cupid-User users) to cache the app
+                                or session of, or 0 to disable (1024).
+  --principal-cache-ttl <time>
+                              Time to cache a token's app or session (or a
+                                user) for ('PT1M').
+  --token-key <key>           Key to sign tokens with, or none to issue
+                                unsigned tokens (None).
+  --token-revocation-interval <time>
+                              Time between reloading the list of revoked
+                                tokens ('PT30S').
+  --graph-engine <engine>     Where to traverse the relationship graph,
+                                'memory' or 'sql' ('memory').
+  --graph-check-interval <time>
+                              Time between relationship graph consistency
+                                checks, or 0 to disable ('PT5M').
+  --graph-cache-size <count>  Graph responses to cache, or 0 to disable
+                                (256).
+  --graph-cache-ttl <time>    Most time to cache a graph response for
+                                ('PT1H').
+  --graph-cache-max-body-size <bytes>
+                              Largest graph response to cache, in bytes
+                                (1048576).
+  --graph-change-retention <time>
+                              Time to keep graph changes for, after which
+                                clients must fetch the whole graph ('P7D').
+  --graph-change-prune-interval <time>
+                              Time between deleting old graph changes, or
+                                0 to disable ('PT1H').
+  --graph-change-prune-batch-size <count>
+                              Most old graph changes to delete at once
+                                (1000).
+  --event-queue-size <count>  Changes to queue for an event stream client
+                                before disconnecting it (1000).
+  --event-keepalive-interval <time>
+                              Time between keepalive messages on idle
+                                event streams ('PT15S').
   --debug                     Whether to run in debug mode (no).
   --testing                   Whether to run in testing mode (no).
                                 Testing mode allows ANY client to WIPE THE
@@ -125,6 +192,7 @@ def manage_app(args: dict[str, Any]):
     if args['--delete']:
         name, id = app.name, app.id
         app.delete_instance()
+        invalidate_principal(app)
         console.print(f'[red]App [bold]{name} ({id})[/bold] deleted.[/red]')
         return
     if name := args['--rename']:
@@ -132,6 +200,8 @@ def manage_app(args: dict[str, Any]):
     if args['--refresh-token']:
         app.secret = secrets.token_bytes()
     app.save()
+    if args['--refresh-token']:
+        invalidate_principal(app)
     print_app(app)
 
 
@@ -149,21 +219,52 @@ def list_apps():
     console.print(table)
 
 
+def run_migrations():
+    """Apply any pending database migrations."""
+    if not (applied := migrate()):
+        console.print('[green]The database is already up to date.[/green]')
+    for name in applied:
+        console.print(f'[green]Applied migration [bold]{name}[/bold].[/green]')
+
+
+def prune_sessions():
+    """Delete every expired session."""
+    batch_size = config.CONFIG.session_prune_batch_size
+    total = 0
+    while (deleted := Session.delete_expired(batch_size)):
+        total += deleted
+        if deleted < batch_size:
+            break
+    console.print(
+        f'[green]Deleted [bold]{total}[/bold] expired session(s).[/green]',
+    )
+
+
 if __name__ == '__main__':
     args = docopt(__doc__, version='Cupid 1.2.1')
     config.load(args)
 
     # Import after loading config, because config starts up code coverage
     # measurement, if we're running it.
-    from .models import App, init_db
+    from .models import (
+        App, PendingMigrationsError, Session, init_db, migrate,
+    )
+    from .principals import invalidate_principal
     from . import routes
 
-    init_db()
+    try:
+        init_db(check_migrations=not args['migrate'])
+    except PendingMigrationsError as error:
+        print_error(str(error))
     if args['create-app']:
         create_app(args)
     elif args['app']:
         manage_app(args)
     elif args['list-apps']:
         list_apps()
+    elif args['migrate']:
+        run_migrations()
+    elif args['prune-sessions']:
+        prune_sessions()
     else:
         routes.run()
@@ -0,0 +1,157 @@
+"""In-memory index of user names, for suggesting users by prefix."""
+from __future__ import annotations
+
+import logging
+import threading
+from typing import Any, Iterator, Optional
+
+from . import models
+
+
+logger = logging.getLogger('cupid')
+
+
+class TrieNode:
+    """A node of a prefix tree, for the names starting with some prefix."""
+
+    __slots__ = ('children', 'user_ids')
+
+    def __init__(self):
+        """Create a node with no names under it."""
+        self.children: dict[str, TrieNode] = {}
+        # Users with a name (or word of a name) ending at this node.
+        self.user_ids: set[int] = set()
+
+
+def get_keys(name: str) -> set[str]:
+    """Get the strings a name should be found by prefixes of.
+
+    A name can be found by the start of any of its words, so that "Smith"
+    suggests "John Smith".
+    """
+    name = name.lower()
+    keys = {name}
+    for index, char in enumerate(name):
+        if char.isspace() and name[index + 1:].strip():
+            keys.add(name[index + 1:].lstrip())
+    return keys
+
+
+class PrefixIndex:
+    """Prefix tree of every user's name.
+
+    The index is loaded from the database once, and then updated from the
+    graph change log whenever a user is created or renamed by any process
+    (see `apply_change`), so suggestions do not need a query. Users are
+    never deleted, except when the whole database is cleared.
+
+    Requests are handled in a pool of threads, so every public method holds
+    a lock while it uses the index.
+    """
+
+    def __init__(self):
+        """Create an empty, unloaded index."""
+        self.root = TrieNode()
+        # The name and discriminator of each user in the index.
+        self.users: dict[int, tuple[str, Optional[str]]] = {}
+        self.loaded = False
+        self.lock = threading.RLock()
+
+    def load(self):
+        """Load (or reload) the index from the database."""
+        users = models.User.select(
+            models.User.id, models.User.name, models.User.discriminator,
+        ).tuples()
+        with self.lock:
+            self.root = TrieNode()
+            self.users = {}
+            for id, name, discriminator in users:
+                self._add(id, name, discriminator)
+            self.loaded = True
+        logger.info(f'Loaded name index with {len(self.users)} users.')
+
+    def clear(self):
+        """Empty the index, eg. after the database has been wiped."""
+        with self.lock:
+            self.root = TrieNode()
+            self.users = {}
+            self.loaded = True
+
+    def _add(self, id: int, name: str, discriminator: Optional[str]):
+        """Add a user who is not in the index yet."""
+        self.users[id] = (name, discriminator)
+        for key in get_keys(name):
+            node = self.root
+            for char in key:
+                node = node.children.setdefault(char, TrieNode())
+            node.user_ids.add(id)
+
+    def _remove(self, id: int):
+        """Remove a user from the index, pruning any empty nodes."""
+        name, _discriminator = self.users.pop(id)
+        for key in get_keys(name):
+            path = [self.root]
+            for char in key:
+                path.append(path[-1].children[char])
+            path[-1].user_ids.discard(id)
+            for depth in range(len(key), 0, -1):
+                if path[depth].user_ids or path[depth].children:
+                    break
+                del path[depth - 1].children[key[depth - 1]]
+
+    def update(self, id: int, name: str, discriminator: Optional[str]):
+        """Add a user to the index, or update their name."""
+        with self.lock:
+            if self.users.get(id) == (name, discriminator):
+                return
+            if id in self.users:
+                self._remove(id)
+            self._add(id, name, discriminator)
+
+    def apply_change(self, change: models.GraphChange):
+        """Update the index with a committed change, if it is to a user."""
+        if change.type == models.ChangeType.USER_UPDATED:
+            user = change.data
+            self.update(int(user['id']), user['name'], user['discriminator'])
+
+    def suggest(self, prefix: str, limit: int) -> list[dict[str, Any]]:
+        """Get up to `limit` users with a name starting with a prefix.
+
+        Names (and words of names) are matched case insensitively, and
+        shorter matches come first.
+        """
+        results = []
+        with self.lock:
+            node = self.root
+            for char in prefix.lower():
+                if not (node := node.children.get(char)):
+                    return results
+            seen = set()
+            for id in self._walk_by_length(node):
+                if id in seen:
+                    continue
+                seen.add(id)
+                name, discriminator = self.users[id]
+                results.append({
+                    'id': str(id),
+                    'name': name,
+                    'discriminator': discriminator,
+                })
+                if len(results) >= limit:
+                    break
+        return results
+
+    def _walk_by_length(self, node: TrieNode) -> Iterator[int]:
+        """Get the user IDs under a node, shortest names first."""
+        level = [node]
+        while level:
+            next_level = []
+            for node in level:
+                yield from sorted(node.user_ids)
+                next_level.extend(
+                    node.children[char] for char in sorted(node.children)
+                )
+            level = next_level
+
+
+PREFIXES = PrefixIndex()
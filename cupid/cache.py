@@ -0,0 +1,76 @@
+"""A small in-memory cache with a size limit and expiry."""
+from __future__ import annotations
+
+import collections
+import threading
+import time
+from datetime import timedelta
+from typing import Any, Callable, Hashable
+
+
+class TTLCache:
+    """A least-recently-used cache whose entries expire after a while.
+
+    The cache is thread safe, and counts hits and misses so that its
+    effectiveness can be reported. A maximum size of 0 disables the cache.
+    """
+
+    def __init__(self, max_size: int, ttl: timedelta):
+        """Create an empty cache."""
+        self.max_size = max_size
+        self.ttl = ttl.total_seconds()
+        self.entries: collections.OrderedDict[Hashable, tuple[float, Any]] = (
+            collections.OrderedDict()
+        )
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Get a value from the cache, if it is there and has not expired."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry:
+                del self.entries[key]
+            self.misses += 1
+            return default
+
+    def set(self, key: Hashable, value: Any):
+        """Store a value in the cache, evicting the oldest if it is full."""
+        if not self.max_size:
+            return
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def discard(self, key: Hashable):
+        """Remove a value from the cache, if it is there."""
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def discard_where(self, predicate: Callable[[Any], bool]):
+        """Remove every value from the cache that matches a predicate."""
+        with self.lock:
+            for key, (_expires, value) in list(self.entries.items()):
+                if predicate(value):
+                    del self.entries[key]
+
+    def clear(self):
+        """Remove every value from the cache."""
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self) -> dict[str, int]:
+        """Get the size of the cache and how often it has been hit."""
+        return {
+            'size': len(self.entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
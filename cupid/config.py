@@ -2,6 +2,7 @@
 from __future__ import annotations
 
 import configparser
+import enum
 import logging
 import os
 import pathlib
@@ -54,6 +55,13 @@ class LogLevel(int):
         )
 
 
+class GraphEngine(enum.Enum):
+    """Where traversal of the relationship graph is done."""
+
+    MEMORY = 'memory'    # An index kept in memory by each server process.
+    SQL = 'sql'          # Recursive queries run by the database.
+
+
 class _Config(pydantic.BaseModel):
     """Config fields."""
 
@@ -63,11 +71,26 @@ class _Config(pydantic.BaseModel):
     db_password: str
     db_host: str = 'localhost'
     db_port: int = 5432
+    db_threads: int = 8    # Threads to make database calls in.
+    db_pool_min_size: int = 1
+    db_pool_max_size: int = 20
+    # How long an idle connection is kept before being replaced.
+    db_pool_stale_timeout: timedelta = timedelta(minutes=5)
+    # How long to wait for a free connection when all are in use.
+    db_pool_timeout: timedelta = timedelta(seconds=10)
 
     # Discord-related configuration.
     discord_api_url: str = 'https://discord.com/api/v8'
     discord_cdn_url: str = 'https://cdn.discordapp.com'
     discord_guild_id: Optional[int] = None
+    discord_max_connections: int = 20
+    discord_global_rate_limit: int = 50    # Requests per second.
+    discord_max_retries: int = 3    # Retries of rate limited requests.
+    # How long an idle connection to Discord is kept open for reuse.
+    discord_keepalive_timeout: timedelta = timedelta(seconds=30)
+    # Users to remember the Discord bearer token of, and for how long.
+    discord_cache_size: int = 1024    # 0 disables.
+    discord_cache_ttl: timedelta = timedelta(minutes=1)
 
     # Logging levels.
     log_level_peewee: LogLevel = logging.INFO    # SQL ORM logs.
@@ -81,6 +104,32 @@ class _Config(pydantic.BaseModel):
     server_port: int = 80
     disable_docs: bool = False    # Disable serving docs.
     session_expiry: timedelta = timedelta(days=30)
+    # Time between deleting expired sessions, and how many to delete at once.
+    session_prune_interval: timedelta = timedelta(hours=1)    # 0 disables.
+    session_prune_batch_size: int = 1000
+    # Tokens to remember the app or session of, and for how long.
+    principal_cache_size: int = 1024    # 0 disables.
+    principal_cache_ttl: timedelta = timedelta(minutes=1)
+    # Key to sign tokens with. If unset, unsigned (version 0) tokens are
+    # issued, which must be checked against the database.
+    token_key: Optional[str] = None
+    # Time between reloading the list of revoked signed tokens.
+    token_revocation_interval: timedelta = timedelta(seconds=30)
+    graph_engine: GraphEngine = GraphEngine.MEMORY
+    graph_check_interval: timedelta = timedelta(minutes=5)    # 0 disables.
+    # Graph responses to keep for as long as the graph is unchanged.
+    graph_cache_size: int = 256    # 0 disables.
+    graph_cache_ttl: timedelta = timedelta(hours=1)
+    graph_cache_max_body_size: int = 1024 * 1024    # Bytes.
+    # How long to keep graph changes for, time between deleting older ones
+    # (0 disables), and how many to delete at once.
+    graph_change_retention: timedelta = timedelta(days=7)
+    graph_change_prune_interval: timedelta = timedelta(hours=1)
+    graph_change_prune_batch_size: int = 1000
+    # Changes to queue for each event stream client before dropping it, and
+    # time between keepalive messages when there are no changes.
+    event_queue_size: int = 1000
+    event_keepalive_interval: timedelta = timedelta(seconds=15)
     debug: bool = False
     # Testing mode allows any client to WIPE THE DATABASE or create an app.
     # It should *never* be enabled on a web-facing server.
@@ -1,9 +1,14 @@
 """Tool for interacting with the Discord API for user authentication."""
+import asyncio
+import collections
+import contextlib
 import dataclasses
-from typing import Any
+import hashlib
+from typing import Any, AsyncIterator, Optional
 
 import aiohttp
 
+from .cache import TTLCache
 from .config import CONFIG
 from .testing import TESTING
 
@@ -13,6 +18,11 @@ NO_AVATAR_URL = '{cdn}/avatars/embed/avatars/{discrim}.png'
 
 session: aiohttp.ClientSession = None
 
+# Users recently authenticated, by the hash of their bearer token.
+USERS: TTLCache = None
+
+scheduler: 'RequestScheduler' = None
+
 
 def get_required_scopes() -> set[str]:
     """Get the scopes a bearer token must have."""
@@ -22,14 +32,34 @@ def get_required_scopes() -> set[str]:
         return {'identify'}
 
 
-async def get_session() -> session:
+def get_cache() -> TTLCache:
+    """Get or create the cache of recently authenticated users."""
+    global USERS
+    if USERS is None:
+        USERS = TTLCache(CONFIG.discord_cache_size, CONFIG.discord_cache_ttl)
+    return USERS
+
+
+async def get_session() -> aiohttp.ClientSession:
     """Get or create the aiohttp session."""
     global session
     if (not session) or session.closed:
-        session = aiohttp.ClientSession()
+        session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(
+            limit=CONFIG.discord_max_connections,
+            keepalive_timeout=CONFIG.discord_keepalive_timeout.total_seconds(),
+        ))
     return session
 
 
+async def close_session():
+    """Close the aiohttp session and its connections, if open."""
+    global scheduler, session
+    if session and not session.closed:
+        await session.close()
+    session = None
+    scheduler = None
+
+
 @dataclasses.dataclass
 class DiscordUser:
     """Data on a Discord user from the Discord API."""
@@ -55,16 +85,190 @@ def get_avatar_url(data: dict[str, Any]) -> str:
     )
 
 
+@dataclasses.dataclass
+class Bucket:
+    """The rate limit state of a Discord bucket, for a single token.
+
+    Requests in the same bucket are made one at a time, so that each can
+    see how many requests the previous one left.
+    """
+
+    lock: asyncio.Lock = dataclasses.field(default_factory=asyncio.Lock)
+    remaining: int = 1
+    reset_at: float = 0    # Event loop time.
+    # Requests waiting for or holding the lock. The lock is not locked while
+    # it is being handed to the next waiter, so this is what says whether
+    # the bucket is in use.
+    users: int = 0
+
+
+class RequestScheduler:
+    """Delays Discord API requests to stay within Discord's rate limits.
+
+    Discord groups routes into buckets, each limiting how many requests can
+    be made with a token before the bucket resets. There is also a global
+    limit on requests per second. Requests which would exceed either limit
+    are queued until the limit resets, and any rate limited responses are
+    retried after the time Discord says to wait.
+    """
+
+    def __init__(self):
+        """Set up the scheduler with no known rate limits."""
+        self.loop = asyncio.get_event_loop()
+        # The bucket ID of each route, once Discord has told us.
+        self.routes: dict[str, str] = {}
+        self.buckets: dict[tuple[str, bytes], Bucket] = {}
+        self.sent: collections.deque[float] = collections.deque()
+        self.global_reset_at = 0.0
+        self.queued = 0
+        self.in_flight = 0
+        self.retries = 0
+
+    async def wait_for_global_limit(self):
+        """Wait until a request can be made within the global limit."""
+        while True:
+            now = self.loop.time()
+            if now < self.global_reset_at:
+                await asyncio.sleep(self.global_reset_at - now)
+                continue
+            while self.sent and self.sent[0] <= now - 1:
+                self.sent.popleft()
+            if len(self.sent) < CONFIG.discord_global_rate_limit:
+                self.sent.append(now)
+                return
+            await asyncio.sleep(self.sent[0] + 1 - now)
+
+    def forget_idle_buckets(self):
+        """Forget buckets with nothing waiting and no limit in effect."""
+        now = self.loop.time()
+        for key, bucket in list(self.buckets.items()):
+            limited = not bucket.remaining and bucket.reset_at > now
+            if not limited and not bucket.users:
+                del self.buckets[key]
+
+    @contextlib.asynccontextmanager
+    async def slot(
+            self, route: str, token_hash: bytes) -> AsyncIterator[Bucket]:
+        """Wait until a request can be made for a route with a token."""
+        key = (self.routes.get(route, route), token_hash)
+        bucket = self.buckets.setdefault(key, Bucket())
+        bucket.users += 1
+        self.queued += 1
+        started = False
+        try:
+            async with bucket.lock:
+                if not bucket.remaining:
+                    await asyncio.sleep(bucket.reset_at - self.loop.time())
+                await self.wait_for_global_limit()
+                self.queued -= 1
+                started = True
+                self.in_flight += 1
+                try:
+                    yield bucket
+                finally:
+                    self.in_flight -= 1
+        finally:
+            if not started:
+                self.queued -= 1
+            bucket.users -= 1
+            self.forget_idle_buckets()
+
+    def update(
+            self,
+            route: str,
+            token_hash: bytes,
+            bucket: Bucket,
+            headers: Any,
+            retry_after: Optional[float] = None,
+            is_global: bool = False):
+        """Record the rate limit state Discord sent with a response.
+
+        `retry_after` should be given if the request was rate limited.
+        """
+        shared = bucket
+        if (bucket_id := headers.get('X-RateLimit-Bucket')) and (
+                self.routes.get(route) != bucket_id):
+            # Requests for this route will now wait on the named bucket.
+            self.routes[route] = bucket_id
+            shared = self.buckets.setdefault((bucket_id, token_hash), bucket)
+        now = self.loop.time()
+        if 'X-RateLimit-Remaining' in headers:
+            bucket.remaining = int(headers['X-RateLimit-Remaining'])
+            bucket.reset_at = now + float(
+                headers.get('X-RateLimit-Reset-After', 0),
+            )
+        else:
+            bucket.remaining = 1
+        if retry_after is not None:
+            if is_global:
+                self.global_reset_at = now + retry_after
+            else:
+                bucket.remaining = 0
+                bucket.reset_at = max(bucket.reset_at, now + retry_after)
+        if shared is not bucket:
+            # Other routes already wait on the named bucket, so it takes on
+            # the state this response reported.
+            shared.remaining = bucket.remaining
+            shared.reset_at = bucket.reset_at
+
+    async def request(self, route: str, token: str) -> Any:
+        """Make a GET request to a Discord API route, within rate limits."""
+        session = await get_session()
+        headers = {'Authorization': 'Bearer ' + token}
+        url = CONFIG.discord_api_url + route
+        token_hash = hashlib.sha256(token.encode()).digest()
+        for attempt in range(CONFIG.discord_max_retries + 1):
+            if attempt:
+                self.retries += 1
+            async with self.slot(route, token_hash) as bucket:
+                async with session.get(url, headers=headers) as response:
+                    try:
+                        data = await response.json()
+                    except ValueError as e:
+                        raise DiscordAuthError(
+                            'Unexpected Discord API response.',
+                        ) from e
+                    if response.status != 429:
+                        self.update(
+                            route, token_hash, bucket, response.headers,
+                        )
+                        return data
+                    self.update(
+                        route,
+                        token_hash,
+                        bucket,
+                        response.headers,
+                        float(data.get('retry_after', 1)),
+                        bool(data.get('global')),
+                    )
+        raise DiscordAuthError(
+            'Discord is rate limiting logins, please try again later.',
+        )
+
+    def stats(self) -> dict[str, int]:
+        """Get how many requests are waiting or being made."""
+        return {
+            'queued': self.queued,
+            'in_flight': self.in_flight,
+            'rate_limited_buckets': sum(
+                1 for bucket in self.buckets.values()
+                if not bucket.remaining and bucket.reset_at > self.loop.time()
+            ),
+            'retries': self.retries,
+        }
+
+
+def get_scheduler() -> RequestScheduler:
+    """Get or create the Discord request scheduler."""
+    global scheduler
+    if not scheduler:
+        scheduler = RequestScheduler()
+    return scheduler
+
+
 async def make_discord_request(endpoint: str, token: str) -> dict[str, Any]:
     """Make a parameter-less GET request to the Discord API."""
-    session = await get_session()
-    headers = {'Authorization': 'Bearer ' + token}
-    endpoint = CONFIG.discord_api_url + endpoint
-    async with session.get(endpoint, headers=headers) as response:
-        try:
-            return await response.json()
-        except ValueError as e:
-            raise DiscordAuthError('Unexpected Discord API response.') from e
+    return await get_scheduler().request(endpoint, token)
 
 
 async def get_user(token: str) -> DiscordUser:
@@ -97,11 +301,24 @@ async def check_guilds(token: str):
 
 
 async def authenticate_user(token: str) -> DiscordUser:
-    """Get data on a user from an user token."""
+    """Get data on a user from an user token.
+
+    The user and their guilds are requested at the same time. Users are
+    cached for a short time, so that logging in again soon after does not
+    need any requests.
+    """
     if TESTING.enabled:
         if token in TESTING.discord_tokens:
             return TESTING.discord_tokens[token]
         raise DiscordAuthError('Unexpected Discord API response.')
-    user = get_user(token)
-    check_guilds(token)
+    key = hashlib.sha256(token.encode()).digest()
+    if user := get_cache().get(key):
+        return user
+    user, guilds_error = await asyncio.gather(
+        get_user(token), check_guilds(token), return_exceptions=True,
+    )
+    for result in (user, guilds_error):
+        if isinstance(result, BaseException):
+            raise result
+    get_cache().set(key, user)
     return user
@@ -0,0 +1,30 @@
+"""JSON encoding, with the fastest library installed.
+
+orjson is used if it is installed, otherwise ujson (a Sanic dependency), or
+the standard library if neither is.
+"""
+import json
+from typing import Any
+
+try:
+    import orjson
+except ImportError:    # pragma: no cover
+    orjson = None
+
+try:
+    import ujson
+except ImportError:    # pragma: no cover
+    ujson = None
+
+
+# The name of the library in use.
+ENCODER = 'orjson' if orjson else 'ujson' if ujson else 'json'
+
+
+def dumps(obj: Any) -> bytes:
+    """Encode an object as compact JSON."""
+    if orjson:
+        return orjson.dumps(obj)
+    if ujson:    # pragma: no cover
+        return ujson.dumps(obj).encode()
+    return json.dumps(obj, separators=(',', ':')).encode()  # pragma: no cover
@@ -0,0 +1,220 @@
+"""Live stream of changes to users and relationships.
+
+Changes are recorded in the graph change log, which notifies every server
+process once they are committed. Each process then loads the new changes
+and passes them to its subscribers.
+"""
+from __future__ import annotations
+
+import asyncio
+import logging
+from typing import Callable, Optional
+
+from .config import CONFIG
+from .encoding import dumps
+from .models import GraphChange, run_in_db_thread
+from .models.graph_change import CHANNEL
+from .notifications import add_handler, add_reconnect_handler
+
+
+logger = logging.getLogger('cupid')
+
+# How many changes to load from the database at once.
+BATCH_SIZE = 1000
+
+# Seconds to wait before trying again if changes could not be loaded.
+RETRY_DELAY = 5
+
+BUS: EventBus = None
+
+
+def get_latest_seq() -> int:
+    """Get the number of the latest change, or 0 if there are none."""
+    _oldest, latest = GraphChange.bounds()
+    return latest
+
+
+def format_event(change: GraphChange) -> bytes:
+    """Serialise a change as a server-sent event."""
+    return b''.join((
+        f'id: {change.seq}\nevent: {change.type.value}\ndata: '.encode(),
+        dumps(change.as_dict()),
+        b'\n\n',
+    ))
+
+
+class Subscriber:
+    """A client receiving changes as they happen.
+
+    Changes wait in a bounded queue until they are sent to the client. If it
+    fills up, the subscriber is dropped, and None is queued to say so.
+    """
+
+    def __init__(self):
+        """Create a subscriber with nothing queued."""
+        # Each change's number and serialised event.
+        self.queue: asyncio.Queue[Optional[tuple[int, bytes]]] = asyncio.Queue(
+            CONFIG.event_queue_size,
+        )
+
+
+class EventBus:
+    """Passes changes to every subscriber in this process.
+
+    Subscribers which fall too far behind are dropped, so that a slow client
+    cannot hold up the others or use unbounded memory. Clients can catch up
+    from the change log when they reconnect.
+    """
+
+    def __init__(self):
+        """Set up the bus with no subscribers."""
+        self.subscribers: set[Subscriber] = set()
+        # The latest change sent to subscribers, and the latest committed.
+        self.last_seq = 0
+        self.latest_seq = 0
+        self.wake = asyncio.Event()
+        # Whether notifications may have been missed, so the latest change
+        # must be checked in the database.
+        self.missed = False
+        self.dropped = 0
+        # Functions to apply each change and to reload from scratch, for
+        # state kept in memory (eg. the name index).
+        self.listeners: list[tuple[
+            Callable[[GraphChange], None], Callable[[], None],
+        ]] = []
+
+    async def load(self):
+        """Start from the latest change (which may be a proposal)."""
+        self.last_seq = self.latest_seq = await run_in_db_thread(
+            get_latest_seq,
+        )
+
+    def handle_notification(self, payload: str):
+        """Record that changes were committed, by any process."""
+        try:
+            self.latest_seq = max(self.latest_seq, int(payload))
+        except ValueError:
+            logger.warning(f'Bad graph change payload "{payload}".')
+            return
+        self.wake.set()
+
+    def handle_reconnect(self):
+        """Catch up with any changes committed while not listening."""
+        self.missed = True
+        self.wake.set()
+
+    def add_listener(
+            self,
+            apply: Callable[[GraphChange], None],
+            reload: Callable[[], None]):
+        """Pass every change committed from now on to a function.
+
+        `reload` is called (in a database thread) instead if some changes
+        were deleted before they could be loaded.
+        """
+        self.listeners.append((apply, reload))
+
+    async def run(self):
+        """Send changes to listeners and subscribers as they are committed.
+
+        If changes cannot be loaded, they are never skipped. Subscribers are
+        dropped, so that they reconnect and replay the changes from the log,
+        and loading is tried again after a delay.
+        """
+        while True:
+            await self.wake.wait()
+            self.wake.clear()
+            try:
+                await self.catch_up()
+            except Exception:
+                logger.exception('Could not pass on graph changes.')
+                self.drop_all()
+                await asyncio.sleep(RETRY_DELAY)
+                self.wake.set()
+
+    async def catch_up(self):
+        """Pass on every change committed since the last one passed on."""
+        if self.missed:
+            latest_seq = await run_in_db_thread(get_latest_seq)
+            self.latest_seq = max(self.latest_seq, latest_seq)
+            self.missed = False
+        while self.last_seq < self.latest_seq:
+            if not (self.subscribers or self.listeners):
+                # Nothing needs these changes.
+                self.last_seq = self.latest_seq
+                return
+            changes = await run_in_db_thread(
+                GraphChange.get_after, self.last_seq, BATCH_SIZE,
+            )
+            if changes is None:
+                # Changes were deleted before they could be passed on (or the
+                # database was cleared), so start again from the latest.
+                await self.resync()
+                return
+            if not changes:
+                # The notified version is not in the log (eg. it was cleared).
+                self.last_seq = self.latest_seq
+                return
+            for change in changes:
+                for apply, _reload in self.listeners:
+                    apply(change)
+                self.publish(change.seq, format_event(change))
+            self.last_seq = changes[-1].seq
+
+    async def resync(self):
+        """Start again from the latest change, after missing some."""
+        self.drop_all()
+        self.last_seq = await run_in_db_thread(get_latest_seq)
+        self.latest_seq = max(self.latest_seq, self.last_seq)
+        for _apply, reload in self.listeners:
+            await run_in_db_thread(reload)
+
+    def publish(self, seq: int, event: bytes):
+        """Queue an event for every subscriber, dropping any that are full."""
+        for subscriber in list(self.subscribers):
+            try:
+                subscriber.queue.put_nowait((seq, event))
+            except asyncio.QueueFull:
+                self.drop(subscriber)
+
+    def subscribe(self) -> Subscriber:
+        """Start queueing changes for a new subscriber."""
+        subscriber = Subscriber()
+        self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        """Stop queueing changes for a subscriber."""
+        self.subscribers.discard(subscriber)
+
+    def drop(self, subscriber: Subscriber):
+        """Disconnect a subscriber which is not keeping up."""
+        self.unsubscribe(subscriber)
+        self.dropped += 1
+        while not subscriber.queue.empty():
+            subscriber.queue.get_nowait()
+        subscriber.queue.put_nowait(None)
+
+    def drop_all(self):
+        """Disconnect every subscriber, eg. when changes could not be sent."""
+        for subscriber in list(self.subscribers):
+            self.drop(subscriber)
+
+    def stats(self) -> dict[str, int]:
+        """Get how many subscribers there are and how many were dropped."""
+        return {
+            'subscribers': len(self.subscribers),
+            'dropped': self.dropped,
+        }
+
+
+def get_bus() -> EventBus:
+    """Get or create the event bus."""
+    global BUS
+    if BUS is None:
+        BUS = EventBus()
+    return BUS
+
+
+add_handler(CHANNEL, lambda payload: get_bus().handle_notification(payload))
+add_reconnect_handler(lambda: get_bus().handle_reconnect())
@@ -0,0 +1,128 @@
+"""Tools which involve analysing the relationship graph."""
+import logging
+from typing import Optional, Union
+
+from .components import ComponentIndex    # noqa:F401
+from .index import GRAPH, GraphIndex, get_connections    # noqa:F401
+from .search import Path, bidirectional_distance    # noqa:F401
+from .sql import SqlGraphEngine
+from ..config import CONFIG, GraphEngine
+from ..models import (
+    Relationship, RelationshipKind, User, get_graph_version,
+)
+
+
+logger = logging.getLogger('cupid')
+
+
+ENGINES = {
+    GraphEngine.MEMORY: GRAPH,
+    GraphEngine.SQL: SqlGraphEngine(),
+}
+
+
+class RelationshipForbidden(ValueError):
+    """An exception indicating that a relationship is not allowed."""
+
+
+def get_engine() -> Union[GraphIndex, SqlGraphEngine]:
+    """Get the configured graph engine."""
+    return ENGINES[CONFIG.graph_engine]
+
+
+def get_current_engine(
+        version: Optional[int] = None) -> Union[GraphIndex, SqlGraphEngine]:
+    """Get the configured graph engine, if it is up to date.
+
+    The in-memory index follows the graph change log, so it can briefly lag
+    behind changes committed by any process. Until it has caught up with the
+    graph version (by default, the current one), the graph is traversed in
+    the database instead.
+    """
+    if CONFIG.graph_engine == GraphEngine.MEMORY:
+        if version is None:
+            version = get_graph_version()
+        if not GRAPH.is_current(version):
+            return ENGINES[GraphEngine.SQL]
+    return get_engine()
+
+
+def distance(
+        user_1: User, user_2: User, max_depth: Optional[int] = None) -> int:
+    """Determine how closely two users are related.
+
+    0 means they are the same user, -1 means they are not related (or, if
+    `max_depth` is given, not within that many relationships).
+    """
+    distance = get_current_engine().distance(user_1.id, user_2.id, max_depth)
+    logger.debug(f'Distance between {user_1.id} and {user_2.id}: {distance}.')
+    return -1 if distance is None else distance
+
+
+def relation_path(
+        user_1_id: int,
+        user_2_id: int,
+        max_depth: Optional[int] = None) -> Optional[Path]:
+    """Get the chain of users and relationships connecting two users.
+
+    Returns None if they are not related (or, if `max_depth` is given, not
+    within that many relationships).
+    """
+    return get_current_engine().path(user_1_id, user_2_id, max_depth)
+
+
+def either_married(user_1: User, user_2: User) -> bool:
+    """Check if either of two users are married."""
+    return bool(Relationship.get_or_none(
+        (
+            (Relationship.initiator_id == user_1.id)
+            | (Relationship.initiator_id == user_2.id)
+            | (Relationship.other_id == user_1.id)
+            | (Relationship.other_id == user_2.id)
+        ) & (Relationship.kind == RelationshipKind.MARRIAGE)
+        & (Relationship.accepted == True),    # noqa:E712
+    ))
+
+
+def is_adopted(user: User) -> bool:
+    """Check if a user has a parent."""
+    return bool(Relationship.get_or_none(
+        Relationship.other_id == user.id,
+        Relationship.accepted == True,    # noqa:E712
+        Relationship.kind == RelationshipKind.ADOPTION,
+    ))
+
+
+def check_relationship(initiator: User, other: User, kind: RelationshipKind):
+    """Make sure that a relationship is allowed.
+
+    This should be called while holding the graph lock (see
+    `Relationship.lock_graph`), so that no relationship can be accepted or
+    deleted between the check and the change it allows.
+    """
+    if get_current_engine().same_component(initiator.id, other.id):
+        raise RelationshipForbidden(
+            'You cannot create a relationship with someone you are already '
+            'related to.',
+        )
+    if kind == RelationshipKind.MARRIAGE:
+        if either_married(initiator, other):
+            raise RelationshipForbidden('A user cannot marry twice.')
+    elif kind == RelationshipKind.ADOPTION:
+        if is_adopted(other):
+            raise RelationshipForbidden('A user can only be adopted once.')
+
+
+def single_user_graph(
+        user_id: int,
+        max_depth: Optional[int] = None,
+        max_nodes: Optional[int] = None,
+        version: Optional[int] = None) -> set[int]:
+    """Get a list of all users related to a user, even distantly.
+
+    If `max_depth` or `max_nodes` are given, only the closest users are
+    included: at most `max_nodes` users, at most `max_depth` relationships
+    away. If `version` is given, the graph includes at least every change
+    up to that graph version.
+    """
+    return get_current_engine(version).subgraph(user_id, max_depth, max_nodes)
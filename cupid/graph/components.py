@@ -0,0 +1,135 @@
+"""Index of which connected component each user belongs to."""
+from __future__ import annotations
+
+import collections
+import itertools
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .index import GraphIndex
+
+
+class ComponentIndex:
+    """Connected component labels over the accepted relationship graph.
+
+    Every user with at least one accepted relationship has a component label,
+    and two users are related (however distantly) exactly when they share a
+    label. Users without any relationships are not stored.
+
+    When two components are joined, the smaller one is relabelled. When a
+    relationship is removed, the two sides are searched in lockstep until
+    either they meet (the component is still connected) or one side runs out,
+    in which case only that (smaller) side is relabelled. Neither case needs
+    to look at the rest of the graph.
+    """
+
+    def __init__(self, graph: GraphIndex):
+        """Create an empty index for a graph."""
+        self.graph = graph
+        self.labels: dict[int, int] = {}
+        self.members: dict[int, set[int]] = {}
+        self._new_labels = itertools.count()
+
+    def clear(self):
+        """Remove every component from the index."""
+        self.labels = {}
+        self.members = {}
+
+    def rebuild(self):
+        """Recalculate every component from the graph's connections."""
+        self.clear()
+        for user_id in self.graph.connections:
+            if user_id not in self.labels:
+                self._relabel(self._reachable(user_id))
+
+    def same_component(self, user_1_id: int, user_2_id: int) -> bool:
+        """Check if two users are related, even distantly."""
+        if user_1_id == user_2_id:
+            return True
+        label = self.labels.get(user_1_id)
+        return label is not None and label == self.labels.get(user_2_id)
+
+    def component(self, user_id: int) -> set[int]:
+        """Get every user in the same component as a user."""
+        if (label := self.labels.get(user_id)) is None:
+            return {user_id}
+        return set(self.members[label])
+
+    def merge(self, user_1_id: int, user_2_id: int):
+        """Update the index after two users have become related."""
+        label_1 = self._label_of(user_1_id)
+        label_2 = self._label_of(user_2_id)
+        if label_1 == label_2:
+            return
+        if len(self.members[label_1]) < len(self.members[label_2]):
+            label_1, label_2 = label_2, label_1
+        moving = self.members.pop(label_2)
+        for user_id in moving:
+            self.labels[user_id] = label_1
+        self.members[label_1] |= moving
+
+    def split(self, user_1_id: int, user_2_id: int):
+        """Update the index after a relationship between users was removed."""
+        seen_1, seen_2 = {user_1_id}, {user_2_id}
+        queue_1 = collections.deque([user_1_id])
+        queue_2 = collections.deque([user_2_id])
+        while True:
+            for seen, queue, other_seen in (
+                    (seen_1, queue_1, seen_2), (seen_2, queue_2, seen_1)):
+                if not queue:
+                    # This side has been fully explored without meeting the
+                    # other side, so it is now a component of its own.
+                    self._relabel(seen)
+                    self._forget_isolated(user_1_id, user_2_id)
+                    return
+                for related_id in self._related(queue.popleft()):
+                    if related_id in other_seen:
+                        return
+                    if related_id not in seen:
+                        seen.add(related_id)
+                        queue.append(related_id)
+
+    def _label_of(self, user_id: int) -> int:
+        """Get the label of a user's component, creating one if needed."""
+        if (label := self.labels.get(user_id)) is None:
+            label = next(self._new_labels)
+            self.labels[user_id] = label
+            self.members[label] = {user_id}
+        return label
+
+    def _related(self, user_id: int) -> dict[int, int]:
+        """Get the users directly related to a user."""
+        return self.graph.connections.get(user_id, {})
+
+    def _reachable(self, user_id: int) -> set[int]:
+        """Find every user reachable from a user by a full search."""
+        seen = {user_id}
+        queue = collections.deque([user_id])
+        while queue:
+            for related_id in self._related(queue.popleft()):
+                if related_id not in seen:
+                    seen.add(related_id)
+                    queue.append(related_id)
+        return seen
+
+    def _relabel(self, user_ids: set[int]):
+        """Give a set of users a new component label of their own."""
+        label = next(self._new_labels)
+        for user_id in user_ids:
+            old_label = self.labels.get(user_id)
+            if old_label is not None and old_label in self.members:
+                self.members[old_label].discard(user_id)
+                if not self.members[old_label]:
+                    del self.members[old_label]
+            self.labels[user_id] = label
+        self.members[label] = set(user_ids)
+
+    def _forget_isolated(self, *user_ids: int):
+        """Remove users who no longer have any relationships."""
+        for user_id in user_ids:
+            if self.graph.connections.get(user_id):
+                continue
+            if (label := self.labels.pop(user_id, None)) is not None:
+                self.members[label].discard(user_id)
+                if not self.members[label]:
+                    del self.members[label]
@@ -0,0 +1,221 @@
+"""In-memory index of the accepted relationship graph."""
+from __future__ import annotations
+
+import logging
+import threading
+from typing import Optional
+
+from .components import ComponentIndex
+from .search import (
+    Path, bidirectional_distance, bidirectional_path, breadth_first_subgraph,
+)
+from ..models import ChangeType, GraphChange, Relationship, get_graph_version
+
+
+logger = logging.getLogger('cupid')
+
+
+def get_connections() -> dict[int, dict[int, int]]:
+    """Get a map of each user to their relations and relationship IDs."""
+    connections = {}
+    relationships = Relationship.select(
+        Relationship.id, Relationship.initiator_id, Relationship.other_id,
+    ).where(Relationship.accepted == True).tuples()    # noqa:E712
+    for rel_id, initiator_id, other_id in relationships:
+        connections.setdefault(initiator_id, {})[other_id] = rel_id
+        connections.setdefault(other_id, {})[initiator_id] = rel_id
+    return connections
+
+
+class GraphIndex:
+    """Adjacency index of every accepted relationship.
+
+    The index is loaded from the database once, and then updated in place
+    from the graph change log whenever a relationship is accepted or deleted
+    by any process (see `apply_change`), so that graph queries do not have to
+    reload every relationship. Connected components are tracked
+    alongside the connections, so checking whether two users are related does
+    not need a search.
+
+    Requests are handled in a pool of threads, so every public method holds
+    a lock while it uses the index.
+    """
+
+    def __init__(self):
+        """Create an empty, unloaded index."""
+        self.connections: dict[int, dict[int, int]] = {}
+        self.components = ComponentIndex(self)
+        self.loaded = False
+        self.lock = threading.RLock()
+        # Counts changes, so that a check can tell if it raced with one.
+        self.changes = 0
+        # The latest change in the graph change log the index includes.
+        self.seq = 0
+
+    def load(self):
+        """Load (or reload) the index from the database.
+
+        The graph version is read first, so a change committed while the
+        relationships are being loaded is applied again when it is passed
+        on, which leaves the index as it was.
+        """
+        seq = get_graph_version()
+        connections = get_connections()
+        with self.lock:
+            self.connections = connections
+            self.components.rebuild()
+            self.loaded = True
+            self.seq = seq
+        logger.info(
+            f'Loaded relationship graph with {len(self.connections)} users.',
+        )
+
+    def clear(self):
+        """Empty the index, eg. after the database has been wiped."""
+        with self.lock:
+            self.connections = {}
+            self.components.clear()
+            self.loaded = True
+            self.changes += 1
+
+    def is_current(self, version: int) -> bool:
+        """Check if the index includes every change up to a graph version."""
+        with self.lock:
+            return self.loaded and self.seq >= version
+
+    def ensure_loaded(self):
+        """Load the index if it has not been loaded yet."""
+        with self.lock:
+            if not self.loaded:
+                self.load()
+
+    def neighbours(self, user_id: int) -> dict[int, int]:
+        """Get a map of a user's relations to relationship IDs.
+
+        The map is not copied, so the lock should be held while using it.
+        """
+        self.ensure_loaded()
+        return self.connections.get(user_id, {})
+
+    def same_component(self, user_1_id: int, user_2_id: int) -> bool:
+        """Check if two users are related, even distantly."""
+        with self.lock:
+            self.ensure_loaded()
+            return self.components.same_component(user_1_id, user_2_id)
+
+    def component(self, user_id: int) -> set[int]:
+        """Get the IDs of every user related to a user, even distantly."""
+        with self.lock:
+            self.ensure_loaded()
+            return self.components.component(user_id)
+
+    def subgraph(
+            self,
+            user_id: int,
+            max_depth: Optional[int] = None,
+            max_nodes: Optional[int] = None) -> set[int]:
+        """Get the IDs of the users closest to a user.
+
+        At most `max_nodes` users are returned, none of whom are more than
+        `max_depth` relationships away.
+        """
+        if max_depth is None and max_nodes is None:
+            return self.component(user_id)
+        with self.lock:
+            return breadth_first_subgraph(
+                self, user_id, max_depth, max_nodes,
+            )
+
+    def distance(
+            self,
+            start_id: int,
+            end_id: int,
+            max_depth: Optional[int] = None) -> Optional[int]:
+        """Find the length of the shortest path between two users.
+
+        Returns None if there is no path (of at most `max_depth`
+        relationships).
+        """
+        with self.lock:
+            if not self.same_component(start_id, end_id):
+                return None
+            return bidirectional_distance(self, start_id, end_id, max_depth)
+
+    def path(
+            self,
+            start_id: int,
+            end_id: int,
+            max_depth: Optional[int] = None) -> Optional[Path]:
+        """Find the users and relationships along the shortest path.
+
+        Returns None if there is no path (of at most `max_depth`
+        relationships).
+        """
+        with self.lock:
+            if not self.same_component(start_id, end_id):
+                return None
+            return bidirectional_path(self, start_id, end_id, max_depth)
+
+    def apply_change(self, change: GraphChange):
+        """Update the index with a committed change, in order.
+
+        Changes from before the index was loaded are skipped, since they are
+        already included.
+        """
+        with self.lock:
+            if not self.loaded or change.seq <= self.seq:
+                return
+            rel = change.data
+            if change.type == ChangeType.RELATIONSHIP_ACCEPTED:
+                self._add(
+                    rel['id'],
+                    int(rel['initiator']['id']),
+                    int(rel['other']['id']),
+                )
+            elif change.type == ChangeType.RELATIONSHIP_DELETED:
+                if rel['accepted']:
+                    self._remove(
+                        int(rel['initiator']['id']), int(rel['other']['id']),
+                    )
+            self.seq = change.seq
+
+    def _add(self, rel_id: int, initiator_id: int, other_id: int):
+        """Add an accepted relationship to the index."""
+        self.connections.setdefault(initiator_id, {})[other_id] = rel_id
+        self.connections.setdefault(other_id, {})[initiator_id] = rel_id
+        self.components.merge(initiator_id, other_id)
+        self.changes += 1
+
+    def _remove(self, initiator_id: int, other_id: int):
+        """Remove a relationship from the index, if it is present."""
+        for user_id, related_id in (
+                (initiator_id, other_id), (other_id, initiator_id)):
+            relations = self.connections.get(user_id, {})
+            relations.pop(related_id, None)
+            if not relations:
+                self.connections.pop(user_id, None)
+        self.components.split(initiator_id, other_id)
+        self.changes += 1
+
+    def check(self) -> bool:
+        """Make sure the index matches the database, rebuilding it if not.
+
+        Returns whether the index was consistent. If the index is changed
+        while the database is being read, the check is abandoned (and counts
+        as consistent), since the two can no longer be compared.
+        """
+        changes = self.changes
+        connections = get_connections()
+        with self.lock:
+            if self.changes != changes or connections == self.connections:
+                return True
+            logger.warning(
+                'Relationship graph index was inconsistent, rebuilding.',
+            )
+            self.connections = connections
+            self.components.rebuild()
+            self.loaded = True
+            return False
+
+
+GRAPH = GraphIndex()
@@ -0,0 +1,131 @@
+"""Searches over the in-memory relationship graph index."""
+from __future__ import annotations
+
+from typing import Optional, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .index import GraphIndex
+
+
+# The IDs of the users along a path, and of the relationships between them.
+Path = tuple[list[int], list[int]]
+
+# A map of users reached by a search to the user and relationship they were
+# reached through (None for the user the search started from).
+Parents = dict[int, Optional[tuple[int, int]]]
+
+
+def _trace(parents: Parents, user_id: int) -> Path:
+    """Follow a search back from a user to where it started."""
+    users, relationships = [user_id], []
+    while (parent := parents[user_id]) is not None:
+        user_id, relationship_id = parent
+        users.append(user_id)
+        relationships.append(relationship_id)
+    users.reverse()
+    relationships.reverse()
+    return users, relationships
+
+
+def _join(
+        parents: Parents,
+        user_id: int,
+        relationship_id: int,
+        related_id: int,
+        other_parents: Parents) -> Path:
+    """Join two searches which met across a relationship into one path."""
+    users, relationships = _trace(parents, user_id)
+    other_users, other_relationships = _trace(other_parents, related_id)
+    return (
+        users + other_users[::-1],
+        relationships + [relationship_id] + other_relationships[::-1],
+    )
+
+
+def bidirectional_path(
+        graph: GraphIndex,
+        start_id: int,
+        end_id: int,
+        max_depth: Optional[int] = None) -> Optional[Path]:
+    """Find the shortest path between two users.
+
+    The search expands one whole level at a time from whichever end has the
+    smaller frontier, and stops as soon as the two searches meet. If
+    `max_depth` is given, the search gives up once it would have to look
+    further than that.
+
+    Returns None if there is no path (of at most `max_depth` relationships).
+    """
+    if start_id == end_id:
+        return [start_id], []
+    parents, other_parents = {start_id: None}, {end_id: None}
+    frontier, other_frontier = [start_id], [end_id]
+    swapped = False
+    depth = 0
+    while frontier and other_frontier:
+        if max_depth is not None and depth >= max_depth:
+            return None
+        if len(frontier) > len(other_frontier):
+            parents, other_parents = other_parents, parents
+            frontier, other_frontier = other_frontier, frontier
+            swapped = not swapped
+        depth += 1
+        next_frontier = []
+        for user_id in frontier:
+            for related_id, rel_id in graph.neighbours(user_id).items():
+                if related_id in other_parents:
+                    users, relationships = _join(
+                        parents, user_id, rel_id, related_id, other_parents,
+                    )
+                    if swapped:
+                        users.reverse()
+                        relationships.reverse()
+                    return users, relationships
+                if related_id not in parents:
+                    parents[related_id] = (user_id, rel_id)
+                    next_frontier.append(related_id)
+        frontier = next_frontier
+    return None
+
+
+def bidirectional_distance(
+        graph: GraphIndex,
+        start_id: int,
+        end_id: int,
+        max_depth: Optional[int] = None) -> Optional[int]:
+    """Find the length of the shortest path between two users.
+
+    Returns None if there is no path (of at most `max_depth` relationships).
+    """
+    if path := bidirectional_path(graph, start_id, end_id, max_depth):
+        return len(path[1])
+    return None
+
+
+def breadth_first_subgraph(
+        graph: GraphIndex,
+        user_id: int,
+        max_depth: Optional[int] = None,
+        max_nodes: Optional[int] = None) -> set[int]:
+    """Get the users closest to a user.
+
+    Users are reached in order of distance, until either `max_nodes` users
+    have been reached or there are no more users within `max_depth`
+    relationships.
+    """
+    reached = {user_id}
+    frontier = [user_id]
+    depth = 0
+    while frontier and (max_depth is None or depth < max_depth):
+        depth += 1
+        next_frontier = []
+        for user_id in frontier:
+            for related_id in graph.neighbours(user_id):
+                if related_id in reached:
+                    continue
+                if max_nodes is not None and len(reached) >= max_nodes:
+                    return reached
+                reached.add(related_id)
+                next_frontier.append(related_id)
+        frontier = next_frontier
+    return reached
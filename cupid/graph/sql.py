@@ -0,0 +1,170 @@
+"""Traversal of the relationship graph using recursive database queries."""
+from __future__ import annotations
+
+from typing import Optional
+
+from .search import Path
+from ..models import db
+
+
+# Every user reachable from a user. UNION (rather than UNION ALL) discards
+# users which have already been reached, so each is only expanded once.
+COMPONENT_QUERY = """
+WITH RECURSIVE reached(id) AS (
+        SELECT %(user_id)s::BIGINT
+    UNION
+        SELECT CASE
+            WHEN rel.initiator_id = reached.id THEN rel.other_id
+            ELSE rel.initiator_id
+        END
+        FROM reached
+        JOIN relationship rel ON rel.accepted AND (
+            rel.initiator_id = reached.id OR rel.other_id = reached.id
+        )
+)
+SELECT id FROM reached
+"""
+
+# Whether one user is reachable from another. Rows of a recursive query are
+# only produced as they are needed, so LIMIT 1 stops the search as soon as
+# the other user is reached.
+RELATED_QUERY = COMPONENT_QUERY + """WHERE id = %(other_id)s LIMIT 1
+"""
+
+# One step of a search from the users reached so far, to every user they
+# are related to which is not already on the path to them. Since accepted
+# relationships form a forest, this means every user is reached exactly once.
+SEARCH_STEP = """
+        FROM search
+        JOIN relationship rel ON rel.accepted AND (
+            rel.initiator_id = search.id OR rel.other_id = search.id
+        )
+        CROSS JOIN LATERAL (
+            SELECT CASE
+                WHEN rel.initiator_id = search.id THEN rel.other_id
+                ELSE rel.initiator_id
+            END AS id
+        ) step
+        WHERE step.id <> ALL(search.path)
+            AND (%(max_depth)s::INT IS NULL OR search.depth < %(max_depth)s)
+"""
+
+# The shortest path from one user to another. Rows are produced one level at
+# a time, so the first match is the shortest path and LIMIT 1 stops the
+# recursion there.
+PATH_QUERY = """
+WITH RECURSIVE search(id, depth, path, relationships) AS (
+        SELECT
+            %(start_id)s::BIGINT,
+            0,
+            ARRAY[%(start_id)s::BIGINT],
+            ARRAY[]::INTEGER[]
+    UNION ALL
+        SELECT
+            step.id,
+            search.depth + 1,
+            search.path || step.id,
+            search.relationships || rel.id
+""" + SEARCH_STEP + """
+            AND search.id <> %(end_id)s
+)
+SELECT path, relationships FROM search WHERE id = %(end_id)s LIMIT 1
+"""
+
+# The users within some distance of a user, closest first. LIMIT stops the
+# recursion once enough users have been found (LIMIT NULL means no limit).
+SUBGRAPH_QUERY = """
+WITH RECURSIVE search(id, depth, path) AS (
+        SELECT %(user_id)s::BIGINT, 0, ARRAY[%(user_id)s::BIGINT]
+    UNION ALL
+        SELECT step.id, search.depth + 1, search.path || step.id
+""" + SEARCH_STEP + """
+)
+SELECT id FROM search LIMIT %(max_nodes)s
+"""
+
+
+class SqlGraphEngine:
+    """Graph engine which traverses relationships inside the database.
+
+    Nothing is kept in memory, so there is no state to load or update when
+    relationships change, and only the IDs that were reached are sent back
+    from the database.
+    """
+
+    def load(self):
+        """Do nothing, since the database is always up to date."""
+
+    def clear(self):
+        """Do nothing, since the database is always up to date."""
+
+    def check(self) -> bool:
+        """Report that the engine is consistent, since it has no state."""
+        return True
+
+    def same_component(self, user_1_id: int, user_2_id: int) -> bool:
+        """Check if two users are related, even distantly."""
+        cursor = db.execute_sql(RELATED_QUERY, {
+            'user_id': user_1_id,
+            'other_id': user_2_id,
+        })
+        return cursor.fetchone() is not None
+
+    def component(self, user_id: int) -> set[int]:
+        """Get the IDs of every user related to a user, even distantly."""
+        cursor = db.execute_sql(COMPONENT_QUERY, {'user_id': user_id})
+        return {id for id, in cursor.fetchall()}
+
+    def subgraph(
+            self,
+            user_id: int,
+            max_depth: Optional[int] = None,
+            max_nodes: Optional[int] = None) -> set[int]:
+        """Get the IDs of the users closest to a user.
+
+        At most `max_nodes` users are returned, none of whom are more than
+        `max_depth` relationships away.
+        """
+        if max_depth is None and max_nodes is None:
+            return self.component(user_id)
+        cursor = db.execute_sql(SUBGRAPH_QUERY, {
+            'user_id': user_id,
+            'max_depth': max_depth,
+            'max_nodes': max_nodes,
+        })
+        return {id for id, in cursor.fetchall()}
+
+    def distance(
+            self,
+            start_id: int,
+            end_id: int,
+            max_depth: Optional[int] = None) -> Optional[int]:
+        """Find the length of the shortest path between two users.
+
+        Returns None if there is no path (of at most `max_depth`
+        relationships).
+        """
+        if path := self.path(start_id, end_id, max_depth):
+            return len(path[1])
+        return None
+
+    def path(
+            self,
+            start_id: int,
+            end_id: int,
+            max_depth: Optional[int] = None) -> Optional[Path]:
+        """Find the users and relationships along the shortest path.
+
+        Returns None if there is no path (of at most `max_depth`
+        relationships).
+        """
+        if start_id == end_id:
+            return [start_id], []
+        cursor = db.execute_sql(PATH_QUERY, {
+            'start_id': start_id,
+            'end_id': end_id,
+            'max_depth': max_depth,
+        })
+        if row := cursor.fetchone():
+            return row[0], row[1]
+        return None
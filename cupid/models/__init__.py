@@ -1,22 +1,60 @@
 """Database models and logic."""
 from .app import App
-from .database import db
+from .database import (    # noqa:F401
+    db,
+    fill_pool,
+    now,
+    run_in_db_thread,
+    shutdown_executor,
+)
+from .graph_change import (    # noqa:F401
+    ChangeType, GraphChange, create_sequence, get_graph_version,
+)
+from .migrations import (    # noqa:F401
+    Migration, PendingMigrationsError, get_pending, mark_applied, migrate,
+)
 from .relationship import Relationship, RelationshipKind    # noqa:F401
+from .revocation import Revocation
 from .session import Session
 from .user import Gender, User    # noqa:F401
 from ..config import CONFIG
 
 
-MODELS = [App, Relationship, Session, User]
+MODELS = [App, GraphChange, Relationship, Revocation, Session, User]
 
 
-def init_db():
-    """Initialise the Peewee database model."""
+def init_db(check_migrations: bool = True):
+    """Initialise the Peewee database model.
+
+    Unless `check_migrations` is False (eg. to apply them), this raises
+    PendingMigrationsError if the database has migrations pending, since
+    the code expects the latest schema.
+    """
     db.init(
         CONFIG.db_name,
         user=CONFIG.db_user,
         password=CONFIG.db_password,
         host=CONFIG.db_host,
         port=CONFIG.db_port,
+        max_connections=CONFIG.db_pool_max_size,
+        stale_timeout=CONFIG.db_pool_stale_timeout.total_seconds(),
+        timeout=CONFIG.db_pool_timeout.total_seconds(),
     )
-    db.create_tables(MODELS)
+    with db.connection_context():
+        if not User.table_exists():
+            # New tables are created with the latest schema. Graph changes
+            # are numbered by the sequence, so it must exist first.
+            create_sequence()
+            db.create_tables([*MODELS, Migration])
+            User.create_trigram_index()
+            mark_applied()
+        else:
+            # Changes to an existing schema (which may be slow, eg. building
+            # indexes) are left to "cupid migrate".
+            Migration.create_table()
+            if check_migrations and (pending := get_pending()):
+                raise PendingMigrationsError(
+                    f'{len(pending)} database migration(s) pending. Run '
+                    '"cupid migrate" to apply them.',
+                )
+        User.detect_trigram_search()
@@ -1,8 +1,21 @@
 """Database and model base class for Peewee ORM."""
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Any, Callable
+
 import peewee
 
+from playhouse.pool import PooledPostgresqlDatabase
+
+from ..config import CONFIG
+
 
-db = peewee.PostgresqlDatabase(None, autorollback=True)
+db = PooledPostgresqlDatabase(None, autorollback=True)
+
+executor: ThreadPoolExecutor = None
 
 
 class BaseModel(peewee.Model):
@@ -13,3 +26,77 @@ class BaseModel(peewee.Model):
 
         use_legacy_table_names = False
         database = db
+
+
+def now() -> datetime:
+    """Get the current time as a naive local time.
+
+    This is how the models' timestamp fields store times (their default is
+    `datetime.now`), so it can be compared with them.
+    """
+    return datetime.now(tz=timezone.utc).astimezone().replace(tzinfo=None)
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """Get or create the pool of threads to make database calls in."""
+    global executor
+    if not executor:
+        executor = ThreadPoolExecutor(
+            max_workers=CONFIG.db_threads, thread_name_prefix='cupid-db',
+        )
+    return executor
+
+
+def shutdown_executor():
+    """Wait for pending database calls and stop the thread pool."""
+    global executor
+    if executor:
+        executor.shutdown()
+        executor = None
+
+
+def with_connection(function: Callable, *args: Any, **kwargs: Any) -> Any:
+    """Call a function with a pooled connection, then return it to the pool.
+
+    Peewee connections are per-thread, so the connection is checked out by
+    the thread doing the work, and only for as long as the work takes.
+    """
+    with db.connection_context():
+        return function(*args, **kwargs)
+
+
+async def run_in_db_thread(
+        function: Callable, *args: Any, **kwargs: Any) -> Any:
+    """Run a blocking function, such as a database call, in a thread.
+
+    This keeps the event loop free to handle other requests while waiting
+    for the database.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        get_executor(),
+        functools.partial(with_connection, function, *args, **kwargs),
+    )
+
+
+def _hold_connection(barrier: threading.Barrier):
+    """Keep a connection checked out until the barrier is passed."""
+    try:
+        barrier.wait(timeout=CONFIG.db_pool_timeout.total_seconds())
+    except threading.BrokenBarrierError:    # pragma: no cover
+        pass
+
+
+async def fill_pool():
+    """Open the configured minimum number of connections ahead of time.
+
+    Each connection is opened in a separate database thread, and the threads
+    wait for each other before returning their connections to the pool, so
+    that the connections are all open at once.
+    """
+    size = min(CONFIG.db_pool_min_size, CONFIG.db_threads)
+    if size:
+        barrier = threading.Barrier(size)
+        await asyncio.gather(*(
+            run_in_db_thread(_hold_connection, barrier) for _ in range(size)
+        ))
@@ -0,0 +1,157 @@
+"""Peewee ORM model for a log of changes to the relationship graph."""
+from __future__ import annotations
+
+import enum
+from datetime import datetime
+from typing import Any, Optional
+
+import peewee
+
+from playhouse.postgres_ext import JSONField
+
+from .database import BaseModel, db, now
+from .enums import EnumField
+from ..config import CONFIG
+
+
+# A Postgres sequence, so that every server process numbers changes in the
+# same order. Each change takes the next number, which is the new version of
+# the graph unless it is a proposal.
+SEQUENCE = 'graph_version'
+
+# Key of the Postgres advisory lock held while recording changes.
+LOCK_ID = 0x6375706964
+
+# Channel to notify every server process of new changes on (see
+# cupid.events), with the number of the latest change.
+CHANNEL = 'cupid_graph_changes'
+
+
+class ChangeType(enum.Enum):
+    """The type of a change to the relationship graph."""
+
+    RELATIONSHIP_PROPOSED = 'relationship_proposed'
+    RELATIONSHIP_ACCEPTED = 'relationship_accepted'
+    RELATIONSHIP_DELETED = 'relationship_deleted'
+    USER_UPDATED = 'user_updated'
+
+
+class GraphChange(BaseModel):
+    """Peewee ORM model for a change to a user or relationship.
+
+    Clients can keep a copy of the graph up to date by applying the changes
+    made since they last fetched it. Changes are only kept for a limited
+    time (see `delete_expired`).
+    """
+
+    seq = peewee.BigIntegerField(
+        primary_key=True,
+        constraints=[peewee.SQL(f"DEFAULT nextval('{SEQUENCE}')")],
+    )
+    type = EnumField(ChangeType)
+    # The user or relationship, as it was after the change.
+    data = JSONField()
+    created_at = peewee.DateTimeField(default=datetime.now, index=True)
+
+    @classmethod
+    def record(cls, type: ChangeType, *entities: Any):
+        """Record a change to some users or relationships.
+
+        This should be called in the same transaction as the change. Other
+        transactions recording changes wait for it to commit, so changes
+        become visible in the order they are numbered, and a client never
+        skips one by asking for the changes after a later one.
+
+        Notifications are only delivered once the transaction commits, so
+        changes are not sent to subscribers until then. Nothing is recorded
+        if no entities are given.
+        """
+        if not entities:
+            return
+        with db.atomic():
+            db.execute_sql('SELECT pg_advisory_xact_lock(%s)', (LOCK_ID,))
+            cls.insert_many([
+                {'type': type, 'data': entity.as_dict()}
+                for entity in entities
+            ]).execute()
+            db.execute_sql(
+                f"SELECT pg_notify(%s, currval('{SEQUENCE}')::text)",
+                (CHANNEL,),
+            )
+
+    @classmethod
+    def bounds(cls) -> tuple[Optional[int], int]:
+        """Get the numbers of the oldest kept and the latest change.
+
+        The oldest is None if there are no changes, and the latest is 0.
+        """
+        oldest, latest = cls.select(
+            peewee.fn.MIN(cls.seq), peewee.fn.MAX(cls.seq),
+        ).tuples().get()
+        return oldest, latest or 0
+
+    @classmethod
+    def select_version(cls) -> peewee.ModelSelect:
+        """Select the graph version, the number of the latest change to it.
+
+        Proposals are not part of the graph (only accepted relationships
+        are), so they are numbered like any other change but do not change
+        its version. This way, proposing a relationship does not invalidate
+        every cached view of the graph.
+        """
+        return cls.select(peewee.fn.MAX(cls.seq)).where(
+            cls.type != ChangeType.RELATIONSHIP_PROPOSED,
+        )
+
+    @classmethod
+    def get_after(cls, seq: int, limit: int) -> Optional[list[GraphChange]]:
+        """Get up to `limit` changes after a version, oldest first.
+
+        Returns None if some of the changes after the version may have been
+        deleted, or the version is newer than any change (eg. because the
+        database was cleared), so the whole graph must be fetched again.
+        """
+        changes = list(cls.select().where(
+            cls.seq > seq,
+        ).order_by(cls.seq).limit(limit))
+        # Checked after getting the changes, in case they were deleted since.
+        oldest, latest = cls.bounds()
+        if seq > latest or (oldest and seq < oldest - 1):
+            return None
+        return changes
+
+    @classmethod
+    def delete_expired(cls, limit: int) -> int:
+        """Delete up to `limit` expired changes, returning how many.
+
+        The change which is the graph version, and any after it, are always
+        kept.
+        """
+        expired = cls.select(cls.seq).where(
+            cls.created_at <= now() - CONFIG.graph_change_retention,
+            cls.seq < cls.select_version(),
+        ).order_by(cls.seq).limit(limit)
+        return cls.delete().where(cls.seq.in_(expired)).execute()
+
+    def as_dict(self) -> dict[str, Any]:
+        """Get the change as a dict for JSON serialisation."""
+        return {
+            'seq': self.seq,
+            'type': self.type.value,
+            'data': self.data,
+            'created_at': self.created_at.timestamp(),
+        }
+
+
+def create_sequence():
+    """Create the graph version sequence if it does not exist."""
+    db.execute_sql(f'CREATE SEQUENCE IF NOT EXISTS {SEQUENCE}')
+
+
+def get_graph_version() -> int:
+    """Get the current graph version (see `GraphChange.select_version`).
+
+    Changes are recorded in the same transaction as the change itself, so
+    once a version can be seen, so can everything changed up to it.
+    """
+    return GraphChange.select_version().scalar() or 0
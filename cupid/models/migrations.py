@@ -0,0 +1,106 @@
+"""Schema migrations for databases created by older versions."""
+from datetime import datetime
+from typing import Callable
+
+import peewee
+
+from playhouse.migrate import PostgresqlMigrator
+
+from .database import BaseModel, db
+from .graph_change import GraphChange, create_sequence
+from .relationship import Relationship
+from .revocation import Revocation
+from .session import Session
+from .user import User
+
+
+class PendingMigrationsError(RuntimeError):
+    """An exception indicating that the database schema is out of date."""
+
+
+class Migration(BaseModel):
+    """Peewee ORM model for a record of an applied migration."""
+
+    name = peewee.CharField(max_length=255, primary_key=True)
+    applied_at = peewee.DateTimeField(default=datetime.now)
+
+
+MigrationFunction = Callable[[PostgresqlMigrator], None]
+
+# Every migration, in the order they should be applied.
+MIGRATIONS: list[MigrationFunction] = []
+
+
+def migration(function: MigrationFunction) -> MigrationFunction:
+    """Register a migration, to be applied after the existing ones.
+
+    Migrations are identified by their function name, so this should never
+    change once a migration has been released.
+    """
+    MIGRATIONS.append(function)
+    return function
+
+
+@migration
+def add_relationship_indexes(migrator: PostgresqlMigrator):
+    """Add indexes for finding relationships by user, status and kind."""
+    # This creates any indexes which do not exist yet (the table does).
+    Relationship.create_table()
+
+
+@migration
+def add_revocations(migrator: PostgresqlMigrator):
+    """Add the table of revoked signed tokens."""
+    Revocation.create_table()
+
+
+@migration
+def add_session_created_at_index(migrator: PostgresqlMigrator):
+    """Add an index for finding expired sessions."""
+    Session.create_table()
+
+
+@migration
+def add_user_name_trigram_index(migrator: PostgresqlMigrator):
+    """Add an index for searching users by name, if supported."""
+    User.create_trigram_index()
+
+
+@migration
+def add_graph_version_sequence(migrator: PostgresqlMigrator):
+    """Add the sequence used to version the relationship graph."""
+    create_sequence()
+
+
+@migration
+def add_graph_changes(migrator: PostgresqlMigrator):
+    """Add the log of changes to the relationship graph."""
+    GraphChange.create_table()
+
+
+def get_pending() -> list[MigrationFunction]:
+    """Get every migration which has not been applied yet."""
+    applied = {migration.name for migration in Migration.select()}
+    return [
+        function for function in MIGRATIONS
+        if function.__name__ not in applied
+    ]
+
+
+def mark_applied():
+    """Record every migration as applied, eg. for a new database."""
+    Migration.insert_many(
+        [{'name': function.__name__} for function in MIGRATIONS],
+    ).on_conflict_ignore().execute()
+
+
+def migrate() -> list[str]:
+    """Apply every pending migration, returning their names."""
+    migrator = PostgresqlMigrator(db)
+    applied = []
+    for function in get_pending():
+        with db.atomic():
+            function(migrator)
+            Migration.create(name=function.__name__)
+        applied.append(function.__name__)
+    return applied
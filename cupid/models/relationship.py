@@ -5,11 +5,16 @@ from typing import Any
 
 import peewee
 
-from .database import BaseModel
+from .database import BaseModel, db
 from .enums import EnumField
 from .user import User
 
 
+# Key of the Postgres advisory lock held while relationships are checked and
+# changed.
+LOCK_ID = 0x72656c6174696f6e
+
+
 class RelationshipKind(enum.Enum):
     """The type of a relationship."""
 
@@ -27,6 +32,32 @@ class Relationship(BaseModel):
     created_at = peewee.DateTimeField(default=datetime.now)
     accepted_at = peewee.DateTimeField(null=True)
 
+    class Meta:
+        """Peewee settings config."""
+
+        # For finding the relationship between two users.
+        indexes = ((('initiator', 'other'), False),)
+
+    @classmethod
+    def lock_graph(cls):
+        """Stop other transactions changing relationships until this ends.
+
+        This must be called inside a transaction, before checking whether a
+        change is allowed, so that nothing can change between the check and
+        the write (eg. two proposals being accepted at once, marrying the
+        same user twice).
+        """
+        db.execute_sql('SELECT pg_advisory_xact_lock(%s)', (LOCK_ID,))
+
+    @classmethod
+    def select_with_users(cls) -> peewee.ModelSelect:
+        """Select relationships, fetching both users in the same query."""
+        initiator = User.alias('initiator')
+        other = User.alias('other')
+        return cls.select(cls, initiator, other).join_from(
+            cls, initiator, on=cls.initiator,
+        ).join_from(cls, other, on=cls.other)
+
     def as_dict(self) -> dict[str, Any]:
         """Get the relationship as a dict for JSON serialisation."""
         return {
@@ -41,6 +72,34 @@ class Relationship(BaseModel):
             ),
         }
 
+    @classmethod
+    def row_fields(cls) -> tuple[peewee.Field, ...]:
+        """Get the fields to select for `row_as_partial_dict`."""
+        return (
+            cls.id,
+            cls.initiator,
+            cls.other,
+            cls.kind,
+            cls.created_at,
+            cls.accepted_at,
+        )
+
+    @staticmethod
+    def row_as_partial_dict(row: tuple) -> dict[str, Any]:
+        """Get a raw row of `row_fields` as a dict, like `as_partial_dict`.
+
+        This is much faster than creating a model instance for each row.
+        """
+        id, initiator_id, other_id, kind, created_at, accepted_at = row
+        return {
+            'id': id,
+            'initiator': str(initiator_id),
+            'other': str(other_id),
+            'kind': kind,
+            'created_at': created_at.timestamp(),
+            'accepted_at': accepted_at.timestamp(),
+        }
+
     def as_partial_dict(self) -> dict[str, Any]:
         """Get the relationship as a dict with minimal information."""
         return {
@@ -51,3 +110,19 @@ class Relationship(BaseModel):
             'created_at': self.created_at.timestamp(),
             'accepted_at': self.accepted_at.timestamp(),
         }
+
+
+# For finding a user's accepted relationships, optionally of a given kind
+# (eg. whether they are married or adopted), and for graph traversal.
+Relationship.add_index(Relationship.index(
+    Relationship.initiator,
+    Relationship.kind,
+    where=Relationship.accepted,
+    name='relationship_accepted_initiator_id_kind',
+))
+Relationship.add_index(Relationship.index(
+    Relationship.other,
+    Relationship.kind,
+    where=Relationship.accepted,
+    name='relationship_accepted_other_id_kind',
+))
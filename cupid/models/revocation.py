@@ -0,0 +1,20 @@
+"""Peewee ORM model for the revocation of an app or session's tokens."""
+from datetime import datetime
+
+import peewee
+
+from .database import BaseModel
+
+
+class Revocation(BaseModel):
+    """Peewee ORM model for the revocation of an app or session's tokens.
+
+    Signed tokens are verified without looking up their app or session, so
+    when a token is refreshed or deleted, a revocation is recorded instead.
+    Any signed token issued before `revoked_at` is rejected.
+    """
+
+    # The value of the token type (see cupid.tokens.TokenType).
+    token_type = peewee.SmallIntegerField()
+    entity_id = peewee.IntegerField()
+    revoked_at = peewee.DateTimeField(default=datetime.now, index=True)
@@ -5,7 +5,7 @@ from typing import Any
 
 import peewee
 
-from .database import BaseModel
+from .database import BaseModel, now
 from .user import User
 from .. import tokens
 from ..config import CONFIG
@@ -16,7 +16,25 @@ class Session(BaseModel):
 
     user = peewee.ForeignKeyField(User)
     secret = peewee.BlobField(default=secrets.token_bytes)
-    created_at = peewee.DateTimeField(default=datetime.now)
+    created_at = peewee.DateTimeField(default=datetime.now, index=True)
+
+    @classmethod
+    def delete_expired(cls, limit: int) -> int:
+        """Delete up to `limit` expired sessions, returning how many."""
+        expired = cls.select(cls.id).where(
+            cls.created_at <= now() - CONFIG.session_expiry,
+        ).limit(limit)
+        return cls.delete().where(cls.id.in_(expired)).execute()
+
+    @property
+    def expires_at(self) -> datetime:
+        """Get the time after which this session can no longer be used."""
+        return self.created_at + CONFIG.session_expiry
+
+    @property
+    def expired(self) -> bool:
+        """Check if this session can no longer be used."""
+        return self.expires_at <= now()
 
     @property
     def token(self) -> str:
@@ -28,8 +46,6 @@ class Session(BaseModel):
         return {
             'id': self.id,
             'user': self.user.as_dict(),
-            'expires_at': (
-                self.created_at + CONFIG.session_expiry
-            ).timestamp(),
+            'expires_at': self.expires_at.timestamp(),
             **({'token': self.token} if with_token else {}),
         }
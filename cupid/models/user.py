@@ -2,14 +2,24 @@
 from __future__ import annotations
 
 import enum
-from typing import Any
+import logging
+import re
+from typing import Any, ClassVar
 
 import peewee
 
-from .database import BaseModel
+from .database import BaseModel, db
 from .enums import EnumField
 
 
+logger = logging.getLogger('cupid')
+
+# A name search with a discriminator, like "Artemis#0019".
+TAG_SEARCH = re.compile(r'^(?P<name>.*)#(?P<discriminator>[0-9]{1,4})$')
+
+TRIGRAM_INDEX = 'user_name_trigram'
+
+
 class Gender(enum.Enum):
     """The gender of a user."""
 
@@ -27,12 +37,109 @@ class User(BaseModel):
     avatar_url = peewee.CharField(max_length=255)
     gender = EnumField(Gender, default=Gender.NON_BINARY)
 
+    # Whether the name trigram index exists (see `create_trigram_index`).
+    trigram_search: ClassVar[bool] = False
+
+    @classmethod
+    def create_trigram_index(cls) -> bool:
+        """Create an index for searching names, if the database supports it.
+
+        This needs the pg_trgm Postgres extension. If it is not available,
+        searches fall back to scanning every name.
+        """
+        try:
+            with db.atomic():
+                db.execute_sql('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+                db.execute_sql(
+                    f'CREATE INDEX IF NOT EXISTS {TRIGRAM_INDEX} ON "user" '
+                    'USING GIN (name gin_trgm_ops)',
+                )
+        except peewee.DatabaseError as error:
+            logger.warning(
+                f'Could not enable the pg_trgm extension, so user search '
+                f'will not be indexed: {error}',
+            )
+            return False
+        return True
+
+    @classmethod
+    def detect_trigram_search(cls):
+        """Check if the name trigram index exists."""
+        cls.trigram_search = bool(db.execute_sql(
+            'SELECT 1 FROM pg_indexes WHERE indexname = %s', (TRIGRAM_INDEX,),
+        ).fetchone())
+
+    @classmethod
+    def search(cls, query: str) -> peewee.ModelSelect:
+        """Search for users by name, best matches first.
+
+        Only the fields of `row_fields` are selected. The query may end with
+        a discriminator (like "name#0019"). Users with that discriminator
+        are then listed first, and each user has a `discriminator_match`
+        attribute (selected after the other fields).
+        """
+        discriminator = None
+        if tag := TAG_SEARCH.match(query):
+            query = tag.group('name')
+            discriminator = tag.group('discriminator').zfill(4)
+        users = cls.select(*cls.row_fields())
+        condition = cls.name ** f'%{query}%'
+        if cls.trigram_search:
+            # Both conditions can use the trigram index.
+            condition |= peewee.Expression(cls.name, '%%', query)
+            rank = peewee.fn.similarity(cls.name, query).desc()
+        else:
+            # Without trigrams, shorter names are closer matches.
+            rank = peewee.fn.length(cls.name)
+        order = [rank, cls.id]
+        if discriminator:
+            match = peewee.fn.COALESCE(
+                cls.discriminator == discriminator, False,
+            )
+            users = users.select_extend(match.alias('discriminator_match'))
+            order.insert(0, match.desc())
+        return users.where(condition).order_by(*order)
+
+    @classmethod
+    def upsert_many(
+            cls,
+            rows: list[dict[str, Any]],
+            update_gender: bool = True) -> list[tuple[User, bool]]:
+        """Create or update users in a single statement.
+
+        Each row must have every field. Existing users have every field
+        overwritten, except their gender if `update_gender` is False. The
+        rows should not contain the same ID twice.
+
+        Returns each user which was created or changed (in no particular
+        order) and a boolean indicating if they were newly created. Users
+        whose details were already the same are not written or returned.
+        """
+        preserve = [cls.name, cls.discriminator, cls.avatar_url]
+        if update_gender:
+            preserve.append(cls.gender)
+        changed = peewee.Expression(
+            peewee.Tuple(*preserve),
+            'IS DISTINCT FROM',
+            peewee.Tuple(*(
+                getattr(peewee.EXCLUDED, field.column_name)
+                for field in preserve
+            )),
+        )
+        users = cls.insert_many(rows).on_conflict(
+            conflict_target=[cls.id], preserve=preserve, where=changed,
+        ).returning(
+            # xmax is only 0 for a row which was inserted, not updated.
+            cls, peewee.SQL('xmax = 0').alias('created'),
+        ).execute()
+        return [(user, user.created) for user in users]
+
     @classmethod
     def from_object(
             cls,
             obj: Any,
             id: int = None,
-            gender: Gender = Gender.NON_BINARY) -> tuple[User, bool]:
+            gender: Gender = Gender.NON_BINARY) -> tuple[User, bool, bool]:
         """Create or update a user from an object.
 
         The object must have `name`, `discriminator` and `avatar_url`
@@ -41,24 +148,43 @@ class User(BaseModel):
         otherwise the `gender` parameter will be used (or the current value,
         if the user is already registered).
 
-        Returns the user and a boolean indicating if they were newly created.
+        Returns the user, a boolean indicating if they were newly created,
+        and one indicating if they were created or changed.
         """
         id = getattr(obj, 'id', id)
-        user = cls.get_or_none(cls.id == id)
-        if user:
-            user.name = obj.name
-            user.discriminator = obj.discriminator
-            user.avatar_url = obj.avatar_url
-            user.gender = getattr(obj, 'gender', user.gender)
-            user.save()
-            return user, False
-        return cls.create(
-            id=id,
-            name=obj.name,
-            discriminator=obj.discriminator,
-            avatar_url=obj.avatar_url,
-            gender=getattr(obj, 'gender', gender),
-        ), True
+        results = cls.upsert_many([{
+            'id': id,
+            'name': obj.name,
+            'discriminator': obj.discriminator,
+            'avatar_url': obj.avatar_url,
+            'gender': getattr(obj, 'gender', gender),
+        }], update_gender=hasattr(obj, 'gender'))
+        if results:
+            [(user, created)] = results
+            return user, created, True
+        return cls.get_by_id(id), False, False
+
+    @classmethod
+    def row_fields(cls) -> tuple[peewee.Field, ...]:
+        """Get the fields to select for `row_as_dict`."""
+        return (
+            cls.id, cls.name, cls.discriminator, cls.avatar_url, cls.gender,
+        )
+
+    @staticmethod
+    def row_as_dict(row: tuple) -> dict[str, Any]:
+        """Get a raw row of `row_fields` as a dict, like `as_dict`.
+
+        This is much faster than creating a model instance for each row.
+        """
+        id, name, discriminator, avatar_url, gender = row
+        return {
+            'id': str(id),
+            'name': name,
+            'discriminator': discriminator,
+            'avatar_url': avatar_url,
+            'gender': gender,
+        }
 
     def as_dict(self) -> dict[str, Any]:
         """Get the user as a dict for JSON serialisation."""
@@ -0,0 +1,136 @@
+"""Messages sent between server processes through Postgres' NOTIFY.
+
+Each server process keeps one connection open, listening on every channel
+which has a handler.
+"""
+import asyncio
+import logging
+from typing import Callable, Optional
+
+import psycopg2
+import psycopg2.extensions
+
+from .config import CONFIG
+
+
+logger = logging.getLogger('cupid')
+
+# Seconds to wait before reconnecting after losing the connection, doubling
+# after each failed attempt up to the maximum.
+RECONNECT_DELAY = 1
+MAX_RECONNECT_DELAY = 60
+
+# The function to call with the payload of each notification, by channel.
+HANDLERS: dict[str, Callable[[str], None]] = {}
+
+# Functions to call after reconnecting, since any notifications sent while
+# the connection was lost were missed.
+RECONNECT_HANDLERS: list[Callable[[], None]] = []
+
+listener: Optional[psycopg2.extensions.connection] = None
+
+reconnecting: Optional[asyncio.Task] = None
+
+
+def add_handler(channel: str, handler: Callable[[str], None]):
+    """Handle notifications on a channel, once listening is started."""
+    HANDLERS[channel] = handler
+
+
+def add_reconnect_handler(handler: Callable[[], None]):
+    """Call a function whenever notifications may have been missed."""
+    RECONNECT_HANDLERS.append(handler)
+
+
+def _handle_notifications():
+    """Pass notifications sent by other processes to their handlers."""
+    global reconnecting
+    try:
+        listener.poll()
+    except psycopg2.Error as error:
+        logger.warning(f'Lost connection for notifications: {error}')
+        loop = asyncio.get_event_loop()
+        _disconnect(loop)
+        reconnecting = loop.create_task(_reconnect(loop))
+        return
+    while listener.notifies:
+        notification = listener.notifies.pop(0)
+        HANDLERS[notification.channel](notification.payload)
+
+
+def _connect() -> psycopg2.extensions.connection:
+    """Open a connection listening on every channel with a handler."""
+    connection = psycopg2.connect(
+        dbname=CONFIG.db_name,
+        user=CONFIG.db_user,
+        password=CONFIG.db_password,
+        host=CONFIG.db_host,
+        port=CONFIG.db_port,
+    )
+    connection.set_isolation_level(
+        psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT,
+    )
+    cursor = connection.cursor()
+    for channel in HANDLERS:
+        cursor.execute(f'LISTEN {channel}')
+    return connection
+
+
+def _listen(
+        loop: asyncio.AbstractEventLoop,
+        connection: psycopg2.extensions.connection):
+    """Start handling notifications received on a connection."""
+    global listener
+    listener = connection
+    loop.add_reader(listener.fileno(), _handle_notifications)
+
+
+def _disconnect(loop: asyncio.AbstractEventLoop):
+    """Close the listening connection, if there is one."""
+    global listener
+    if not listener:
+        return
+    loop.remove_reader(listener.fileno())
+    listener.close()
+    listener = None
+
+
+async def _reconnect(loop: asyncio.AbstractEventLoop):
+    """Keep trying to listen again, waiting longer after each failure."""
+    global reconnecting
+    delay = RECONNECT_DELAY
+    while True:
+        await asyncio.sleep(delay)
+        try:
+            # Connecting can take a while, so it is not done in the loop.
+            connection = await loop.run_in_executor(None, _connect)
+        except psycopg2.Error as error:
+            delay = min(delay * 2, MAX_RECONNECT_DELAY)
+            logger.warning(
+                f'Could not reconnect for notifications, retrying in '
+                f'{delay}s: {error}',
+            )
+            continue
+        _listen(loop, connection)
+        reconnecting = None
+        logger.info('Reconnected for notifications.')
+        for handler in RECONNECT_HANDLERS:
+            handler()
+        return
+
+
+def start_listening(loop: asyncio.AbstractEventLoop):
+    """Start receiving notifications from other processes.
+
+    If the connection is lost, it is reopened in the background.
+    """
+    _listen(loop, _connect())
+
+
+def stop_listening(loop: asyncio.AbstractEventLoop):
+    """Stop receiving notifications from other processes."""
+    global reconnecting
+    if reconnecting:
+        reconnecting.cancel()
+        reconnecting = None
+    _disconnect(loop)
@@ -0,0 +1,124 @@
+"""Cache of the apps and sessions that unsigned tokens authenticate as.
+
+Signed tokens are checked without the database, so are not cached. Entries
+are invalidated when a token is refreshed or its app or session is
+deleted. Since that might happen in a different process (for example, the
+command line tool, or another server worker), invalidations are also sent
+to every server process through Postgres' NOTIFY.
+
+The users that app tokens act for (with the Cupid-User header) are cached
+the same way, and invalidated when the graph change log says they changed
+(see `apply_user_change`).
+"""
+from __future__ import annotations
+
+import logging
+from typing import Optional, Union
+
+from .cache import TTLCache
+from .config import CONFIG
+from .models import App, ChangeType, GraphChange, Session, User, db
+from .notifications import add_handler, add_reconnect_handler
+from .tokens import REVOCATIONS, Token, TokenParseError, TokenType
+
+
+logger = logging.getLogger('cupid')
+
+CHANNEL = 'cupid_principals'
+
+PRINCIPALS: TTLCache = None
+
+
+def get_cache() -> TTLCache:
+    """Get or create the principal cache."""
+    global PRINCIPALS
+    if PRINCIPALS is None:
+        PRINCIPALS = TTLCache(
+            CONFIG.principal_cache_size, CONFIG.principal_cache_ttl,
+        )
+    return PRINCIPALS
+
+
+def get_principal(token: str) -> Union[App, Session]:
+    """Get the app or session a token authenticates as.
+
+    A new model instance is returned each time, even when cached, so that
+    handlers can safely modify it.
+    """
+    parsed = Token.from_token(token)
+    if parsed.version != 0:
+        return parsed.to_entity()
+    if cached := get_cache().get(token):
+        model, data = cached
+        entity = model(**data)
+        if model is Session and entity.expired:
+            get_cache().discard(token)
+            raise TokenParseError('Token has expired.')
+        return entity
+    entity = parsed.to_entity()
+    get_cache().set(token, (type(entity), dict(entity.__data__)))
+    return entity
+
+
+def get_user(id: int) -> Optional[User]:
+    """Get a user by ID, or None if they do not exist.
+
+    As with principals, a new model instance is returned each time. Users
+    who do not exist are not cached, since they may be created at any time.
+    """
+    if cached := get_cache().get((User, id)):
+        model, data = cached
+        return model(**data)
+    if user := User.get_or_none(User.id == id):
+        get_cache().set((User, id), (User, dict(user.__data__)))
+    return user
+
+
+def apply_user_change(change: GraphChange):
+    """Stop caching a user once a change to them has been committed."""
+    if change.type == ChangeType.USER_UPDATED:
+        get_cache().discard((User, int(change.data['id'])))
+
+
+def discard_users():
+    """Stop caching every user, eg. after missing some changes."""
+    get_cache().discard_where(lambda cached: cached[0] is User)
+
+
+def _discard(type: TokenType, id: int):
+    """Remove every cached token for an app or session in this process."""
+    model = App if type == TokenType.APP else Session
+    get_cache().discard_where(
+        lambda cached: cached[0] is model and cached[1]['id'] == id,
+    )
+
+
+def invalidate_principal(entity: Union[App, Session]):
+    """Stop accepting existing tokens for an app or session.
+
+    This revokes any signed tokens and stops caching unsigned ones, in every
+    process. Other processes are only notified once the transaction commits.
+    """
+    type = TokenType.APP if isinstance(entity, App) else TokenType.SESSION
+    # Peewee does not commit a SELECT by itself, so without a transaction the
+    # notification would be discarded.
+    with db.atomic():
+        REVOCATIONS.revoke(type, entity.id)
+        db.execute_sql(
+            'SELECT pg_notify(%s, %s)', (CHANNEL, f'{type.name}:{entity.id}'),
+        )
+    _discard(type, entity.id)
+
+
+def _handle_invalidation(payload: str):
+    """Apply an invalidation sent by another process."""
+    type_name, _, id = payload.partition(':')
+    try:
+        _discard(TokenType[type_name], int(id))
+    except (KeyError, ValueError):
+        logger.warning(f'Bad token invalidation payload "{payload}".')
+
+
+add_handler(CHANNEL, _handle_invalidation)
+# Invalidations may have been missed while not listening.
+add_reconnect_handler(lambda: get_cache().clear())
@@ -1,3 +1,3 @@
 """Sanic API routes."""
-from . import auth, relationships, testing, users    # noqa:F401
-from .utils import run                               # noqa:F401
+from . import auth, events, relationships, stats, testing, users  # noqa:F401
+from .utils import run                                              # noqa:F401
@@ -5,11 +5,26 @@ import pydantic
 
 from sanic.exceptions import SanicException
 from sanic.request import Request
-from sanic.response import HTTPResponse, json
+from sanic.response import HTTPResponse
 
-from .utils import app, authenticated, parse_body
-from ..discord import DiscordAuthError, authenticate_user
-from ..models import Session, User
+from .utils import (
+    app,
+    authenticated,
+    in_db_thread,
+    json,
+    load_requester,
+    parse_body,
+)
+from ..discord import DiscordAuthError, DiscordUser, authenticate_user
+from ..models import (
+    ChangeType,
+    GraphChange,
+    Session,
+    User,
+    db,
+    run_in_db_thread,
+)
+from ..principals import invalidate_principal
 
 
 class LoginForm(pydantic.BaseModel):
@@ -18,6 +33,15 @@ class LoginForm(pydantic.BaseModel):
     token: str
 
 
+def register_user(user_data: DiscordUser) -> tuple[User, bool]:
+    """Create or update a user who has logged in."""
+    with db.atomic():
+        user, created, changed = User.from_object(user_data)
+        if changed:
+            GraphChange.record(ChangeType.USER_UPDATED, user)
+    return user, created
+
+
 @app.post('/auth/login')
 @parse_body(LoginForm)
 async def discord_authenticate(request: Request) -> HTTPResponse:
@@ -26,32 +50,36 @@ async def discord_authenticate(request: Request) -> HTTPResponse:
         user_data = await authenticate_user(request.ctx.body.token)
     except DiscordAuthError as error:
         raise SanicException(str(error), 422) from error
-    user, created = User.from_object(user_data)
-    return json(
-        Session.create(user=user).as_dict(with_token=True),
-        201 if created else 200,
-    )
+    user, created = await run_in_db_thread(register_user, user_data)
+    session = await run_in_db_thread(Session.create, user=user)
+    return json(session.as_dict(with_token=True), 201 if created else 200)
 
 
 @app.get('/auth/me')
 @authenticated
-async def get_self(request: Request) -> HTTPResponse:
+@in_db_thread
+def get_self(request: Request) -> HTTPResponse:
     """Get information on the authenticated user or app."""
-    return json(request.ctx.requester.as_dict())
+    return json(load_requester(request).as_dict())
 
 
 @app.delete('/auth/me')
 @authenticated
-async def delete_session(request: Request) -> HTTPResponse:
+@in_db_thread
+def delete_session(request: Request) -> HTTPResponse:
     """Delete the current authentication session or app."""
     request.ctx.requester.delete_instance()
+    invalidate_principal(request.ctx.requester)
     return HTTPResponse(status=204)
 
 
 @app.patch('/auth/me')
 @authenticated
-async def refresh_token(request: Request) -> HTTPResponse:
+@in_db_thread
+def refresh_token(request: Request) -> HTTPResponse:
     """Refresh the token of the authenticated app or session."""
-    request.ctx.requester.secret = secrets.token_bytes()
-    request.ctx.requester.save()
-    return json(request.ctx.requester.as_dict(with_token=True))
+    requester = load_requester(request)
+    requester.secret = secrets.token_bytes()
+    requester.save()
+    invalidate_principal(requester)
+    return json(requester.as_dict(with_token=True))
@@ -0,0 +1,90 @@
+"""Endpoint for streaming changes to users and relationships."""
+import asyncio
+from typing import Optional
+
+import pydantic
+
+from sanic.request import Request
+from sanic.response import HTTPResponse
+
+from .utils import ValidationLocationError, app, app_authenticated, parse_args
+from ..config import CONFIG
+from ..events import format_event, get_bus
+from ..models import GraphChange, run_in_db_thread
+
+
+# Sent when a client has to catch up from the change log before reconnecting.
+RESYNC_EVENT = b'event: resync\ndata: {}\n\n'
+
+KEEPALIVE = b': keepalive\n\n'
+
+
+class EventsForm(pydantic.BaseModel):
+    """Form for choosing where to start an event stream."""
+
+    # The graph version to send the changes after, if the client does not
+    # send a Last-Event-ID header.
+    since: Optional[pydantic.conint(ge=0)] = None
+
+
+def get_start(request: Request) -> Optional[int]:
+    """Get the graph version a client wants the changes after, if any."""
+    if last_event_id := request.headers.get('last-event-id'):
+        try:
+            return EventsForm(since=last_event_id).since
+        except pydantic.ValidationError as e:
+            raise ValidationLocationError.PARAMS from e
+    return request.ctx.args.since
+
+
+@app.get('/events')
+@app_authenticated
+@parse_args(EventsForm)
+async def stream_events(request: Request) -> Optional[HTTPResponse]:
+    """Stream changes to users and relationships as server-sent events.
+
+    If the client has missed changes (for example, when reconnecting), these
+    are sent first. If it has missed too many, it is told to resync and
+    disconnected. Clients which do not keep up are disconnected, and can
+    reconnect to get the changes they missed.
+    """
+    since = get_start(request)
+    bus = get_bus()
+    # Subscribe before loading missed changes, so none are missed in between.
+    subscriber = bus.subscribe()
+    try:
+        missed = []
+        if since is not None:
+            missed = await run_in_db_thread(
+                GraphChange.get_after, since, CONFIG.event_queue_size + 1,
+            )
+        response = await request.respond(
+            content_type='text/event-stream',
+            headers={'Cache-Control': 'no-cache'},
+        )
+        if missed is None or len(missed) > CONFIG.event_queue_size:
+            await response.send(RESYNC_EVENT)
+            await response.eof()
+            return None
+        last_seq = since or 0
+        for change in missed:
+            await response.send(format_event(change))
+            last_seq = change.seq
+        interval = CONFIG.event_keepalive_interval.total_seconds()
+        while True:
+            try:
+                item = await asyncio.wait_for(subscriber.queue.get(), interval)
+            except asyncio.TimeoutError:
+                await response.send(KEEPALIVE)
+                continue
+            if item is None:
+                # Dropped for falling behind.
+                await response.eof()
+                return None
+            seq, event = item
+            # Changes may be queued which were also sent as missed changes.
+            if seq > last_seq:
+                await response.send(event)
+                last_seq = seq
+    finally:
+        bus.unsubscribe(subscriber)
@@ -5,18 +5,26 @@ import pydantic
 
 from sanic.exceptions import SanicException
 from sanic.request import Request
-from sanic.response import HTTPResponse, json
+from sanic.response import HTTPResponse
 
 from .utils import (
     app,
     get_relationship,
     get_relationship_or_none,
     get_user_by_id,
+    in_db_thread,
+    json,
     parse_body,
     user_authenticated,
 )
 from ..graph import RelationshipForbidden, check_relationship
-from ..models import Relationship, RelationshipKind
+from ..models import (
+    ChangeType,
+    GraphChange,
+    Relationship,
+    RelationshipKind,
+    db,
+)
 
 
 class RelationshipForm(pydantic.BaseModel):
@@ -28,47 +36,65 @@ class RelationshipForm(pydantic.BaseModel):
 @app.post('/user/<id:int>/relationship')
 @parse_body(RelationshipForm)
 @user_authenticated
-async def propose_relationship(request: Request, id: int) -> HTTPResponse:
+@in_db_thread
+def propose_relationship(request: Request, id: int) -> HTTPResponse:
     """Create a new relationship proposal."""
-    if get_relationship_or_none(request.ctx.user.id, id):
-        raise RelationshipForbidden(
-            'You cannot have multiple relationships with one user.',
-        )
     initiator = request.ctx.user
     other = get_user_by_id(id)
-    check_relationship(initiator, other, request.ctx.body.kind)
-    return json(Relationship.create(
-        initiator=initiator, other=other, kind=request.ctx.body.kind,
-    ).as_dict(), 201)
+    with db.atomic():
+        Relationship.lock_graph()
+        if get_relationship_or_none(initiator.id, id):
+            raise RelationshipForbidden(
+                'You cannot have multiple relationships with one user.',
+            )
+        check_relationship(initiator, other, request.ctx.body.kind)
+        rel = Relationship.create(
+            initiator=initiator, other=other, kind=request.ctx.body.kind,
+        )
+        GraphChange.record(ChangeType.RELATIONSHIP_PROPOSED, rel)
+    return json(rel.as_dict(), 201)
 
 
 @app.get('/user/<id:int>/relationship')
 @user_authenticated
-async def get_own_relationship(request: Request, id: int) -> HTTPResponse:
+@in_db_thread
+def get_own_relationship(request: Request, id: int) -> HTTPResponse:
     """Get your relationship with a user."""
     return json(get_relationship(request.ctx.user.id, id).as_dict())
 
 
 @app.post('/user/<id:int>/relationship/accept')
 @user_authenticated
-async def accept_relationship(request: Request, id: int) -> HTTPResponse:
+@in_db_thread
+def accept_relationship(request: Request, id: int) -> HTTPResponse:
     """Accept a relationship proposal."""
-    rel = get_relationship(request.ctx.user.id, id)
-    if rel.accepted:
-        raise SanicException('Relationship already accepted.', 409)
-    if rel.other.id == id:
-        raise SanicException('You cannot accept a proposal you created.', 403)
-    # Make sure circumstances have not changed since the proposal was created.
-    check_relationship(rel.initiator, rel.other, rel.kind)
-    rel.accepted = True
-    rel.accepted_at = datetime.now(tz=timezone.utc)
-    rel.save()
+    with db.atomic():
+        Relationship.lock_graph()
+        rel = get_relationship(request.ctx.user.id, id)
+        if rel.accepted:
+            raise SanicException('Relationship already accepted.', 409)
+        if rel.other.id == id:
+            raise SanicException(
+                'You cannot accept a proposal you created.', 403,
+            )
+        # Make sure circumstances have not changed since the proposal was
+        # created.
+        check_relationship(rel.initiator, rel.other, rel.kind)
+        rel.accepted = True
+        rel.accepted_at = datetime.now(tz=timezone.utc)
+        rel.save()
+        GraphChange.record(ChangeType.RELATIONSHIP_ACCEPTED, rel)
     return json(rel.as_dict())
 
 
 @app.delete('/user/<id:int>/relationship')
 @user_authenticated
-async def leave_relationship(request: Request, id: int) -> HTTPResponse:
+@in_db_thread
+def leave_relationship(request: Request, id: int) -> HTTPResponse:
     """Leave or decline a relationship."""
-    get_relationship(request.ctx.user.id, id).delete_instance()
+    with db.atomic():
+        Relationship.lock_graph()
+        rel = get_relationship(request.ctx.user.id, id)
+        rel.delete_instance()
+        GraphChange.record(ChangeType.RELATIONSHIP_DELETED, rel)
     return HTTPResponse(status=204)
@@ -0,0 +1,20 @@
+"""Endpoints for monitoring the server."""
+from sanic.request import Request
+from sanic.response import HTTPResponse
+
+from .utils import app, app_authenticated, get_graph_cache, json
+from .. import discord, principals
+from ..events import get_bus
+
+
+@app.get('/stats')
+@app_authenticated
+async def get_stats(request: Request) -> HTTPResponse:
+    """Get statistics on this server process's caches."""
+    return json({
+        'principal_cache': principals.get_cache().stats(),
+        'discord_cache': discord.get_cache().stats(),
+        'discord_requests': discord.get_scheduler().stats(),
+        'graph_cache': get_graph_cache().stats(),
+        'events': get_bus().stats(),
+    })
@@ -8,12 +8,15 @@ from typing import Any, Callable, Optional
 import pydantic
 
 from sanic.request import Request
-from sanic.response import HTTPResponse, file, json
+from sanic.response import HTTPResponse, file
 
-from .utils import app, parse_body
+from .utils import app, get_graph_cache, in_db_thread, json, parse_body
 from .. import discord
+from ..autocomplete import PREFIXES
 from ..config import CONFIG
+from ..graph import get_engine
 from ..models import App, MODELS
+from ..principals import get_cache
 from ..testing import TESTING
 
 
@@ -60,17 +63,23 @@ async def check_testing(request: Request) -> HTTPResponse:
 
 @app.post('/testing/clear')
 @testing_only
-async def clear_database(request: Request) -> HTTPResponse:
+@in_db_thread
+def clear_database(request: Request) -> HTTPResponse:
     """Clear every table in the entire database."""
     for model in MODELS:
         model.delete().execute()
+    get_engine().clear()
+    get_cache().clear()
+    PREFIXES.clear()
+    get_graph_cache().clear()
     return HTTPResponse(status=204)
 
 
 @app.post('/testing/app')
 @testing_only
 @parse_body(AppCreateForm)
-async def create_app(request: Request) -> HTTPResponse:
+@in_db_thread
+def create_app(request: Request) -> HTTPResponse:
     """Create a new app."""
     return json(
         App.create(name=request.ctx.body.name).as_dict(with_token=True),
@@ -1,25 +1,48 @@
 """Routes for getting and managing users."""
 import math
-from typing import Optional
+from typing import Any, Generator, Iterator, Optional
 
 import peewee
 
 import pydantic
 
+from sanic.exceptions import NotFound, SanicException
 from sanic.request import Request
-from sanic.response import HTTPResponse, json
+from sanic.response import HTTPResponse
 
 from .utils import (
     app,
     app_authenticated,
     authenticated,
     get_user_by_id,
+    graph_versioned,
+    in_db_thread,
+    json,
     parse_args,
     parse_body,
+    stream_from_db_jobs,
     user_authenticated,
 )
-from ..graph import single_user_graph
-from ..models import Gender, Relationship, User
+from ..autocomplete import PREFIXES
+from ..config import GraphEngine
+from ..encoding import dumps
+from ..graph import ENGINES, Path, relation_path, single_user_graph
+from ..models import (
+    ChangeType,
+    Gender,
+    GraphChange,
+    Relationship,
+    User,
+    db,
+)
+
+
+# How many users to upsert in each statement of a bulk update.
+BULK_CHUNK_SIZE = 1000
+
+# How many users or relationships to read in each database job while
+# streaming the graph.
+GRAPH_PAGE_SIZE = 1000
 
 
 class UserForm(pydantic.BaseModel):
@@ -31,6 +54,18 @@ class UserForm(pydantic.BaseModel):
     discriminator: Optional[pydantic.constr(regex=r'^[0-9]{1,4}$')]  # noqa:F722,E501
 
 
+class BulkUserForm(UserForm):
+    """Form for creating or updating one of a batch of users."""
+
+    id: int
+
+
+class BulkUsersForm(pydantic.BaseModel):
+    """Form for creating or updating a batch of users."""
+
+    users: pydantic.conlist(BulkUserForm, min_items=1, max_items=10_000)
+
+
 class GenderUpdateForm(pydantic.BaseModel):
     """Form for changing a user's gender."""
 
@@ -41,35 +76,132 @@ class PaginationForm(pydantic.BaseModel):
     """Form for getting a paginated list of results."""
 
     search: Optional[str] = None
-    per_page: int = 20
-    page: int = 0
+    per_page: pydantic.conint(ge=1, le=100) = 20
+    page: pydantic.conint(ge=0) = 0
+    # The ID of the last user already seen, to get the users after it.
+    after: Optional[int] = None
+
+
+class AutocompleteForm(pydantic.BaseModel):
+    """Form for getting user suggestions from the start of a name."""
+
+    prefix: pydantic.constr(min_length=1, max_length=255)
+    limit: pydantic.conint(ge=1, le=100) = 25
+
+
+class SubgraphForm(pydantic.BaseModel):
+    """Form for limiting how much of a user's graph to get."""
+
+    depth: Optional[pydantic.conint(ge=0)] = None
+    max_nodes: Optional[pydantic.conint(ge=1)] = None
+
+
+class GraphChangesForm(pydantic.BaseModel):
+    """Form for getting the changes to the graph since a version."""
+
+    since: pydantic.conint(ge=0)
+    limit: pydantic.conint(ge=1, le=1000) = 100
+
+
+class PathForm(pydantic.BaseModel):
+    """Form for limiting the search for a path between two users."""
+
+    max_depth: Optional[pydantic.conint(ge=0)] = None
+
+
+def listed_user_dict(row: tuple) -> dict[str, Any]:
+    """Get a raw user row from a list as a dict, with any match details.
+
+    The row has the fields of `User.row_fields`, and may be followed by
+    whether the user's discriminator matched the search.
+    """
+    fields = len(User.row_fields())
+    data = User.row_as_dict(row[:fields])
+    if len(row) > fields:
+        data['discriminator_match'] = bool(row[fields])
+    return data
 
 
 @app.get('/users/list')
 @authenticated
 @parse_args(PaginationForm)
-async def list_users(request: Request) -> HTTPResponse:
-    """Get a paginated list of users with associated data."""
-    users = User.select()
-    if search := request.ctx.args.search:
-        users = users.where(User.name ** f'%{search}%')
-    total = len(users)
-    users = users.offset(request.ctx.args.page * request.ctx.args.per_page)
-    users = users.limit(request.ctx.args.per_page)
+@in_db_thread
+def list_users(request: Request) -> HTTPResponse:
+    """Get a paginated list of users with associated data.
+
+    Pages can be selected either by number, or (more efficiently for later
+    pages) by the ID of the last user on the previous page.
+    """
+    args = request.ctx.args
+    if args.search:
+        users = User.search(args.search)
+    else:
+        users = User.select(*User.row_fields())
+    total = users.count()
+    if args.after is not None:
+        users = users.where(User.id > args.after).order_by(User.id)
+    else:
+        users = users.offset(args.page * args.per_page)
+        if not args.search:
+            users = users.order_by(User.id)
+    # Raw rows, since creating model instances is slow.
+    rows = db.execute(users.limit(args.per_page)).fetchall()
+    # Search results are ranked, so can't be continued from an ID.
+    ordered_by_id = args.after is not None or not args.search
     return json({
-        'page': request.ctx.args.page,
-        'per_page': request.ctx.args.per_page,
-        'pages': math.ceil(total / request.ctx.args.per_page),
+        'page': args.page,
+        'per_page': args.per_page,
+        'pages': math.ceil(total / args.per_page),
         'total': total,
-        'users': [user.as_dict() for user in users],
+        'next_after': (
+            str(rows[-1][0])
+            if ordered_by_id and len(rows) == args.per_page else None
+        ),
+        'users': [listed_user_dict(row) for row in rows],
     })
 
 
-@app.get('/users/graph')
+@app.get('/users/autocomplete')
 @authenticated
-async def get_user_graph(request: Request) -> HTTPResponse:
-    """Get a graph of all users and their relationships."""
-    users = User.select().join(
+@parse_args(AutocompleteForm)
+async def autocomplete_users(request: Request) -> HTTPResponse:
+    """Suggest users whose name starts with a prefix."""
+    return json({
+        'users': PREFIXES.suggest(
+            request.ctx.args.prefix, request.ctx.args.limit,
+        ),
+    })
+
+
+def paginate(query: peewee.Select, id: peewee.Field) -> Iterator[list[tuple]]:
+    """Get the raw rows of a query a page at a time, in order of ID.
+
+    Each page is read with a separate query, after the last ID of the one
+    before, so nothing is held open between pages.
+    """
+    after = None
+    while True:
+        page = query if after is None else query.where(id > after)
+        rows = db.execute(
+            page.order_by(id).limit(GRAPH_PAGE_SIZE),
+        ).fetchall()
+        if rows:
+            yield rows
+        if len(rows) < GRAPH_PAGE_SIZE:
+            return
+        after = rows[-1][0]
+
+
+def serialise_user_graph() -> Generator[bytes, None, None]:
+    """Serialise the graph of all users and their relationships in chunks.
+
+    Each chunk is a page of rows, read with its own query, so chunks can be
+    made in separate database jobs. Changes made while the graph is read
+    may be partly included, but are all in the change log after the graph
+    version the response is tagged with, so clients applying the changes
+    since then end up with a consistent graph.
+    """
+    users = User.select(*User.row_fields()).join(
         Relationship,
         peewee.JOIN.LEFT_OUTER,
         on=(
@@ -77,87 +209,256 @@ async def get_user_graph(request: Request) -> HTTPResponse:
             | (User.id == Relationship.other_id)
         ) & (Relationship.accepted == True),    # noqa: E712
     ).where(Relationship.id.is_null(False)).group_by(User.id)
-    user_data = {str(user.id): user.as_dict() for user in users}
-    relationships = [
-        rel.as_partial_dict() for rel in Relationship.select().where(
-            Relationship.accepted == True,    # noqa: E712
+    relationships = Relationship.select(*Relationship.row_fields()).where(
+        Relationship.accepted == True,    # noqa: E712
+    )
+    chunk = [b'{"users":{']
+    separator = b''
+    for rows in paginate(users, User.id):
+        for row in rows:
+            user = dumps(User.row_as_dict(row))
+            chunk.append(b'%s"%d":%s' % (separator, row[0], user))
+            separator = b','
+        yield b''.join(chunk)
+        chunk = []
+    chunk.append(b'},"relationships":[')
+    separator = b''
+    for rows in paginate(relationships, Relationship.id):
+        for row in rows:
+            rel = dumps(Relationship.row_as_partial_dict(row))
+            chunk.append(separator + rel)
+            separator = b','
+        yield b''.join(chunk)
+        chunk = []
+    chunk.append(b']}')
+    yield b''.join(chunk)
+
+
+@app.get('/users/graph')
+@authenticated
+@graph_versioned
+async def get_user_graph(request: Request) -> HTTPResponse:
+    """Get a graph of all users and their relationships.
+
+    The graph is streamed a page at a time as it is read from the database,
+    so it is never held in memory all at once, however large it is.
+    """
+    return stream_from_db_jobs(serialise_user_graph())
+
+
+@app.get('/users/graph/changes')
+@authenticated
+@parse_args(GraphChangesForm)
+@in_db_thread
+def get_graph_changes(request: Request) -> HTTPResponse:
+    """Get the changes to users and relationships since a graph version.
+
+    Only recent changes are kept, so a client which has fallen too far
+    behind has to fetch the whole graph again.
+    """
+    args = request.ctx.args
+    changes = GraphChange.get_after(args.since, args.limit + 1)
+    if changes is None:
+        raise SanicException(
+            'Changes since this version are no longer available, fetch the '
+            'whole graph again.',
+            410,
         )
-    ]
+    more = len(changes) > args.limit
+    changes = changes[:args.limit]
     return json({
-        'users': user_data,
-        'relationships': relationships,
+        'version': changes[-1].seq if changes else args.since,
+        'more': more,
+        'changes': [change.as_dict() for change in changes],
+    })
+
+
+@app.put('/users')
+@app_authenticated
+@parse_body(BulkUsersForm)
+@in_db_thread
+def update_users(request: Request) -> HTTPResponse:
+    """Update or register the details of a batch of users.
+
+    Users are upserted in chunks, each with a single statement, in one
+    transaction. If the same user is given more than once, the last details
+    given are used.
+    """
+    # A single statement cannot update the same row twice.
+    rows = list({
+        user.id: user.dict() for user in request.ctx.body.users
+    }.values())
+    # The status of each user who was created or changed. Users whose
+    # details were already the same are left out, so no-op syncs are not
+    # logged.
+    statuses = {}
+    users = []
+    with db.atomic():
+        for start in range(0, len(rows), BULK_CHUNK_SIZE):
+            chunk = rows[start:start + BULK_CHUNK_SIZE]
+            for user, was_created in User.upsert_many(chunk):
+                statuses[user.id] = 'created' if was_created else 'updated'
+                users.append(user)
+        GraphChange.record(ChangeType.USER_UPDATED, *users)
+    return json({
+        'users': [
+            {
+                'id': str(user.id),
+                'status': statuses.get(user.id, 'unchanged'),
+            }
+            for user in request.ctx.body.users
+        ],
     })
 
 
 @app.put('/users/me/gender')
 @user_authenticated
 @parse_body(GenderUpdateForm)
-async def update_own_gender(request: Request) -> HTTPResponse:
+@in_db_thread
+def update_own_gender(request: Request) -> HTTPResponse:
     """Update or register a user's details by ID."""
-    request.ctx.user.gender = request.ctx.body.gender
-    request.ctx.user.save()
+    gender = request.ctx.body.gender
+    with db.atomic():
+        # Nothing is written or recorded if the gender is already the same.
+        users = list(User.update(gender=gender).where(
+            User.id == request.ctx.user.id, User.gender != gender,
+        ).returning(User).execute())
+        GraphChange.record(ChangeType.USER_UPDATED, *users)
+    request.ctx.user.gender = gender
     return json(request.ctx.user.as_dict())
 
 
 @app.get('/user/<id:int>')
 @authenticated
-async def get_user(request: Request, id: int) -> HTTPResponse:
+@in_db_thread
+def get_user(request: Request, id: int) -> HTTPResponse:
     """Get a user by ID."""
     user = get_user_by_id(id)
-    accepted = Relationship.select().where(
-        (
-            (Relationship.initiator_id == id)
-            | (Relationship.other_id == id)
-        ),
-        Relationship.accepted == True,    # noqa:E712
-    )
-    incoming = Relationship.select().where(
-        Relationship.other_id == id,
-        Relationship.accepted == False,    # noqa:E712
-    )
-    outgoing = Relationship.select().where(
-        Relationship.initiator_id == id,
-        Relationship.accepted == False,    # noqa:E712
-    )
+    relationships = {'accepted': [], 'incoming': [], 'outgoing': []}
+    for rel in Relationship.select_with_users().where(
+            (Relationship.initiator_id == id) | (Relationship.other_id == id),
+    ).order_by(Relationship.id):
+        if rel.accepted:
+            status = 'accepted'
+        elif rel.other_id == id:
+            status = 'incoming'
+        else:
+            status = 'outgoing'
+        relationships[status].append(rel.as_dict())
     return json({
         'user': user.as_dict(),
-        'relationships': {
-            'accepted': [rel.as_dict() for rel in accepted],
-            'incoming': [rel.as_dict() for rel in incoming],
-            'outgoing': [rel.as_dict() for rel in outgoing],
-        },
+        'relationships': relationships,
     })
 
 
 @app.get('/user/<id:int>/graph')
 @authenticated
-async def get_single_user_graph(request: Request, id: int) -> HTTPResponse:
-    """Get a graph of all users related to one user."""
-    get_user_by_id(id)
-    user_ids = single_user_graph(id)
+@parse_args(SubgraphForm)
+@graph_versioned
+@in_db_thread
+def get_single_user_graph(request: Request, id: int) -> HTTPResponse:
+    """Get a graph of all users related to one user.
+
+    The graph may be limited to the users closest to the user, in which case
+    users who have relationships that were left out are marked as truncated.
+    """
+    user_ids = single_user_graph(
+        id,
+        request.ctx.args.depth,
+        request.ctx.args.max_nodes,
+        request.ctx.graph_version,
+    )
+    # Raw rows, since creating model instances is slow for large graphs.
     users = {
-        str(user.id): user.as_dict() for user in User.select()
-        if user.id in user_ids
-    }
-    relationships = [
-        rel.as_partial_dict() for rel in Relationship.select().where(
-            Relationship.accepted == True,    # noqa: E712
-            (
-                (Relationship.initiator_id << user_ids)
-                | (Relationship.other_id << user_ids)
-            ),
+        str(row[0]): User.row_as_dict(row)
+        for row in db.execute(
+            User.select(*User.row_fields()).where(User.id << user_ids),
         )
-    ]
+    }
+    if str(id) not in users:
+        raise NotFound(f'User not found by ID {id}.')
+    relationships = []
+    truncated = set()
+    rows = db.execute(Relationship.select(*Relationship.row_fields()).where(
+        Relationship.accepted == True,    # noqa: E712
+        (
+            (Relationship.initiator_id << user_ids)
+            | (Relationship.other_id << user_ids)
+        ),
+    ))
+    for row in rows:
+        initiator_id, other_id = row[1], row[2]
+        if initiator_id not in user_ids:
+            truncated.add(other_id)
+        elif other_id not in user_ids:
+            truncated.add(initiator_id)
+        else:
+            relationships.append(Relationship.row_as_partial_dict(row))
     return json({
         'users': users,
         'relationships': relationships,
+        'truncated': [str(user_id) for user_id in truncated],
+    })
+
+
+def load_path(
+        path: Path) -> Optional[tuple[list[User], list[Relationship]]]:
+    """Load the users and relationships along a path, in order.
+
+    Returns None if any of them have been deleted since the path was found.
+    """
+    user_ids, relationship_ids = path
+    users = {
+        user.id: user for user in User.select().where(User.id << user_ids)
+    }
+    relationships = {
+        rel.id: rel for rel in Relationship.select().where(
+            Relationship.id << relationship_ids,
+        )
+    }
+    if len(users) < len(user_ids) or (
+            len(relationships) < len(relationship_ids)):
+        return None
+    return (
+        [users[user_id] for user_id in user_ids],
+        [relationships[rel_id] for rel_id in relationship_ids],
+    )
+
+
+@app.get('/user/<id:int>/path/<other_id:int>')
+@authenticated
+@parse_args(PathForm)
+@in_db_thread
+def get_relation_path(
+        request: Request, id: int, other_id: int) -> HTTPResponse:
+    """Get the chain of relationships connecting two users."""
+    get_user_by_id(id)
+    get_user_by_id(other_id)
+    max_depth = request.ctx.args.max_depth
+    path = relation_path(id, other_id, max_depth)
+    loaded = path and load_path(path)
+    if path and not loaded:
+        # The path changed after it was found, so find it again in the
+        # database, which is always up to date.
+        path = ENGINES[GraphEngine.SQL].path(id, other_id, max_depth)
+        loaded = path and load_path(path)
+    if not loaded:
+        raise NotFound(f'Users {id} and {other_id} are not related.')
+    users, relationships = loaded
+    return json({
+        'users': [user.as_dict() for user in users],
+        'relationships': [rel.as_partial_dict() for rel in relationships],
     })
 
 
 @app.put('/user/<id:int>')
 @app_authenticated
 @parse_body(UserForm)
-async def update_user(request: Request, id: int) -> HTTPResponse:
+@in_db_thread
+def update_user(request: Request, id: int) -> HTTPResponse:
     """Update or register a user's details by ID."""
-    user, created = User.from_object(request.ctx.body, id=id)
+    with db.atomic():
+        user, created, changed = User.from_object(request.ctx.body, id=id)
+        if changed:
+            GraphChange.record(ChangeType.USER_UPDATED, user)
     return json(user.as_dict(), 201 if created else 200)
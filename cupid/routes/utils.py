@@ -1,24 +1,52 @@
 """Utilities common to the route handlers."""
+import asyncio
 import enum
 import functools
+import logging
 import os
-from typing import Any, Callable, Optional, Type, Union
+from typing import Any, Awaitable, Callable, Generator, Optional, Type, Union
 
 import pydantic
 
 from sanic import Sanic
 from sanic.exceptions import Forbidden, NotFound, SanicException
 from sanic.request import Request
-from sanic.response import HTTPResponse, json
-
-from ..config import BASE_PATH, CONFIG
-from ..graph import RelationshipForbidden
-from ..models import App, Relationship, User
-from ..tokens import Token, TokenParseError
-
+from sanic.response import HTTPResponse, raw, stream
+from sanic.response import json as json_response
+
+from .. import discord
+from ..autocomplete import PREFIXES
+from ..cache import TTLCache
+from ..config import BASE_PATH, CONFIG, GraphEngine
+from ..encoding import dumps
+from ..events import get_bus
+from ..graph import GRAPH, RelationshipForbidden, get_engine
+from ..models import (
+    App,
+    GraphChange,
+    Relationship,
+    Session,
+    User,
+    db,
+    fill_pool,
+    get_graph_version,
+    run_in_db_thread,
+    shutdown_executor,
+)
+from ..notifications import start_listening, stop_listening
+from ..principals import (
+    apply_user_change, discard_users, get_principal, get_user,
+)
+from ..tokens import REVOCATIONS, TokenParseError
+
+
+logger = logging.getLogger('cupid')
 
 app = Sanic('cupid', configure_logging=False)
 
+# Serialised graph responses, by URL and graph version.
+GRAPH_CACHE: TTLCache = None
+
 
 def run():
     """Run the app."""
@@ -35,10 +63,180 @@ def run():
     )
 
 
+async def run_periodically(
+        name: str, interval: float, job: Callable[[], Awaitable[Any]]):
+    """Run a job every `interval` seconds, for as long as the server runs.
+
+    If the job fails (eg. because the database is briefly unavailable), the
+    error is logged and the job is tried again at the next interval.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await job()
+        except Exception:
+            logger.exception(f'Periodic task "{name}" failed.')
+
+
+async def check_graph_periodically():
+    """Regularly make sure the relationship graph index is consistent."""
+    await run_periodically(
+        'check graph',
+        CONFIG.graph_check_interval.total_seconds(),
+        lambda: run_in_db_thread(get_engine().check),
+    )
+
+
+async def refresh_revocations_periodically():
+    """Regularly reload the list of revoked signed tokens."""
+    await run_periodically(
+        'refresh revocations',
+        CONFIG.token_revocation_interval.total_seconds(),
+        lambda: run_in_db_thread(REVOCATIONS.refresh),
+    )
+
+
+async def prune_sessions_periodically():
+    """Regularly delete expired sessions, a batch at a time."""
+    batch_size = CONFIG.session_prune_batch_size
+
+    async def prune():
+        """Delete batches of expired sessions until there are none left."""
+        # Each batch is a separate job so that requests are not held up.
+        while await run_in_db_thread(
+                Session.delete_expired, batch_size) == batch_size:
+            pass
+
+    await run_periodically(
+        'prune sessions',
+        CONFIG.session_prune_interval.total_seconds(),
+        prune,
+    )
+
+
+async def prune_graph_changes_periodically():
+    """Regularly delete graph changes older than the retention time."""
+    batch_size = CONFIG.graph_change_prune_batch_size
+
+    async def prune():
+        """Delete batches of expired changes until there are none left."""
+        while await run_in_db_thread(
+                GraphChange.delete_expired, batch_size) == batch_size:
+            pass
+
+    await run_periodically(
+        'prune graph changes',
+        CONFIG.graph_change_prune_interval.total_seconds(),
+        prune,
+    )
+
+
+@app.listener('before_server_start')
+async def open_connections(app: Sanic, loop: asyncio.AbstractEventLoop):
+    """Open database connections before they are needed by requests."""
+    await fill_pool()
+
+
+@app.listener('before_server_start')
+async def start_event_bus(app: Sanic, loop: asyncio.AbstractEventLoop):
+    """Start passing graph changes on from the current graph version.
+
+    This must start before the in-memory indexes which follow changes are
+    loaded, so that no change is missed in between.
+    """
+    await get_bus().load()
+    app.add_task(get_bus().run())
+
+
+@app.listener('before_server_start')
+async def load_graph(app: Sanic, loop: asyncio.AbstractEventLoop):
+    """Load the relationship graph index, and keep it up to date."""
+    memory = CONFIG.graph_engine == GraphEngine.MEMORY
+    if memory:
+        get_bus().add_listener(GRAPH.apply_change, GRAPH.load)
+    await run_in_db_thread(get_engine().load)
+    if memory and CONFIG.graph_check_interval:
+        app.add_task(check_graph_periodically())
+
+
+@app.listener('before_server_start')
+async def load_name_index(app: Sanic, loop: asyncio.AbstractEventLoop):
+    """Load the user name index, and keep it up to date with changes."""
+    get_bus().add_listener(PREFIXES.apply_change, PREFIXES.load)
+    await run_in_db_thread(PREFIXES.load)
+
+
+@app.listener('before_server_start')
+async def follow_user_changes(app: Sanic, loop: asyncio.AbstractEventLoop):
+    """Stop caching users' details once they have changed."""
+    get_bus().add_listener(apply_user_change, discard_users)
+
+
+@app.listener('before_server_start')
+async def load_revocations(app: Sanic, loop: asyncio.AbstractEventLoop):
+    """Load the list of revoked signed tokens, if they are accepted."""
+    if CONFIG.token_key:
+        await run_in_db_thread(REVOCATIONS.refresh)
+        app.add_task(refresh_revocations_periodically())
+
+
+@app.listener('before_server_start')
+async def start_pruning_sessions(app: Sanic, loop: asyncio.AbstractEventLoop):
+    """Start regularly deleting expired sessions, unless disabled."""
+    if CONFIG.session_prune_interval:
+        app.add_task(prune_sessions_periodically())
+
+
+@app.listener('before_server_start')
+async def start_pruning_graph_changes(
+        app: Sanic, loop: asyncio.AbstractEventLoop):
+    """Start regularly deleting old graph changes, unless disabled."""
+    if CONFIG.graph_change_prune_interval:
+        app.add_task(prune_graph_changes_periodically())
+
+
+@app.listener('before_server_start')
+async def listen_for_notifications(
+        app: Sanic, loop: asyncio.AbstractEventLoop):
+    """Start receiving invalidations and changes from other processes."""
+    start_listening(loop)
+
+
+@app.listener('after_server_stop')
+async def stop_listening_for_notifications(
+        app: Sanic, loop: asyncio.AbstractEventLoop):
+    """Stop receiving invalidations and changes from other processes."""
+    stop_listening(loop)
+
+
+@app.listener('before_server_start')
+async def open_discord_session(app: Sanic, loop: asyncio.AbstractEventLoop):
+    """Create the session used to make requests to Discord."""
+    await discord.get_session()
+
+
+@app.listener('after_server_stop')
+async def close_discord_session(app: Sanic, loop: asyncio.AbstractEventLoop):
+    """Close the session used to make requests to Discord."""
+    await discord.close_session()
+
+
+@app.listener('after_server_stop')
+async def close_connections(app: Sanic, loop: asyncio.AbstractEventLoop):
+    """Stop the database threads and close connections once stopped."""
+    shutdown_executor()
+    db.close_all()
+
+
 class AuthError(ValueError):
     """An error when parsing the authorisation header."""
 
 
+def json(body: Any, status: int = 200, **kwargs: Any) -> HTTPResponse:
+    """Create a JSON response, encoded with the fastest library installed."""
+    return json_response(body, status, dumps=dumps, **kwargs)
+
+
 class ValidationLocationError(ValueError, enum.Enum):
     """An error to represent the location another error occurred in.
 
@@ -95,7 +293,7 @@ def get_user_by_id(id: int) -> User:
 def get_relationship_or_none(
         user_1_id: int, user_2_id: int) -> Optional[Relationship]:
     """Get a relationship between two users if it exists."""
-    return Relationship.get_or_none(
+    return Relationship.select_with_users().where(
         (
             (Relationship.initiator_id == user_1_id)
             & (Relationship.other_id == user_2_id)
@@ -103,7 +301,7 @@ def get_relationship_or_none(
             (Relationship.initiator_id == user_2_id)
             & (Relationship.other_id == user_1_id)
         ),
-    )
+    ).first()
 
 
 def get_relationship(user_1_id: int, user_2_id: int) -> Relationship:
@@ -115,6 +313,138 @@ def get_relationship(user_1_id: int, user_2_id: int) -> Relationship:
     )
 
 
+def in_db_thread(handler: Callable) -> Callable:
+    """Decorate a blocking handler to run it in a database thread.
+
+    The handler itself should be synchronous, and this should be the
+    innermost decorator.
+    """
+    @functools.wraps(handler)
+    async def decorated(request: Request, *args: Any, **kwargs: Any) -> Any:
+        """Run the handler in a database thread."""
+        return await run_in_db_thread(handler, request, *args, **kwargs)
+    return decorated
+
+
+def get_graph_cache() -> TTLCache:
+    """Get or create the cache of graph responses."""
+    global GRAPH_CACHE
+    if GRAPH_CACHE is None:
+        GRAPH_CACHE = TTLCache(CONFIG.graph_cache_size, CONFIG.graph_cache_ttl)
+    return GRAPH_CACHE
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """Check if a request's If-None-Match header includes an ETag."""
+    if not (header := request.headers.get('if-none-match')):
+        return False
+    tags = {tag.strip().removeprefix('W/') for tag in header.split(',')}
+    return '*' in tags or etag in tags
+
+
+class CachingStream:
+    """Wrapper for a streamed response which keeps a copy of its body.
+
+    The copy is discarded if the body is longer than `max_size`.
+    """
+
+    def __init__(self, response: Any, max_size: int):
+        """Wrap a streamed response."""
+        self.response = response
+        self.max_size = max_size
+        self.chunks: Optional[list[bytes]] = []
+        self.size = 0
+
+    async def write(self, data: bytes):
+        """Send and keep a chunk of the body."""
+        if self.chunks is not None:
+            self.size += len(data)
+            if self.size > self.max_size:
+                self.chunks = None
+            else:
+                self.chunks.append(data)
+        await self.response.write(data)
+
+    @property
+    def body(self) -> Optional[bytes]:
+        """Get the whole body, if it was short enough to keep."""
+        return None if self.chunks is None else b''.join(self.chunks)
+
+
+def cache_graph_stream(response: Any, key: tuple):
+    """Cache the body of a streamed graph response, if it is small enough.
+
+    The body is only cached once it has been sent in full.
+    """
+    streaming_fn = response.streaming_fn
+
+    async def caching_fn(response: Any):
+        """Stream the response, then cache its body."""
+        caching = CachingStream(response, CONFIG.graph_cache_max_body_size)
+        await streaming_fn(caching)
+        if (body := caching.body) is not None:
+            get_graph_cache().set(key, body)
+
+    response.streaming_fn = caching_fn
+
+
+def graph_versioned(handler: Callable) -> Callable:
+    """Decorate a handler for a view of the graph to cache its responses.
+
+    Responses are tagged with the graph version, so clients can check if
+    the graph has changed with a conditional request, or get the changes
+    since with /users/graph/changes. The serialised body is cached until the
+    graph changes.
+
+    The version is stored as `request.ctx.graph_version`. Handlers must
+    include every change up to it (eg. by passing it to the graph engine),
+    so that a body is never cached or tagged as newer than it is.
+    """
+    @functools.wraps(handler)
+    async def decorated(request: Request, *args: Any, **kwargs: Any) -> Any:
+        """Respond from the cache if the graph has not changed."""
+        version = await run_in_db_thread(get_graph_version)
+        request.ctx.graph_version = version
+        headers = {'ETag': f'"{version}"'}
+        if etag_matches(request, headers['ETag']):
+            return HTTPResponse(status=304, headers=headers)
+        key = (request.path, request.query_string, version)
+        if (body := get_graph_cache().get(key)) is not None:
+            return raw(body, content_type='application/json', headers=headers)
+        response = await handler(request, *args, **kwargs)
+        if response.status == 200:
+            if isinstance(response, HTTPResponse):
+                get_graph_cache().set(key, response.body)
+            else:
+                cache_graph_stream(response, key)
+            response.headers.update(headers)
+        return response
+    return decorated
+
+
+def stream_from_db_jobs(
+        chunks: Generator[bytes, None, None],
+        content_type: str = 'application/json') -> Any:
+    """Create a response streaming the chunks made by a blocking generator.
+
+    Each chunk is made in a separate database job, and sent from the event
+    loop before the next is made, so the response is never held in memory
+    and a slow client never holds up a database thread. The generator must
+    not keep a transaction or cursor open between chunks.
+    """
+    async def streaming_fn(response: Any):
+        """Make each chunk in a database thread, then send it."""
+        try:
+            while (
+                    chunk := await run_in_db_thread(next, chunks, None)
+            ) is not None:
+                await response.write(chunk)
+        finally:
+            chunks.close()
+
+    return stream(streaming_fn, content_type=content_type)
+
+
 def parse_args(
         model: Type[pydantic.BaseModel]) -> Callable[[Callable], Callable]:
     """Create a decorator to parse the request args as a Pydantic type."""
@@ -164,7 +494,22 @@ def authenticate_token(request: Request):
     if scheme.lower() != 'bearer':
         raise AuthError('The "Bearer" authorisation scheme is required.')
     # We have a custom handler for token parse errors.
-    request.ctx.requester = Token.from_token(token).to_entity()
+    request.ctx.requester = get_principal(token)
+
+
+def load_requester(request: Request) -> Union[App, Session]:
+    """Get every field of the app or session a request authenticated as.
+
+    Signed tokens are checked without loading the app or session from the
+    database, so this loads it if that has not been done yet.
+    """
+    requester = request.ctx.requester
+    if 'secret' not in requester.__data__:
+        model = type(requester)
+        if not (requester := model.get_or_none(model.id == requester.id)):
+            raise TokenParseError('Token has been revoked.')
+        request.ctx.requester = requester
+    return requester
 
 
 def authenticate_user(request: Request):
@@ -183,7 +528,7 @@ def authenticate_user(request: Request):
             user_id = int(header)
         except ValueError as e:
             raise AuthError('Cupid-User header malformed.') from e
-        if not (user := User.get_or_none(User.id == user_id)):
+        if not (user := get_user(user_id)):
             raise AuthError('User from Cupid-User header not found.')
         request.ctx.user = user
 
@@ -193,7 +538,7 @@ def authenticated(handler: Callable) -> Callable:
     @functools.wraps(handler)
     async def decorated(request: Request, *args: Any, **kwargs: Any) -> Any:
         """Make sure the client is authenticated."""
-        authenticate_token(request)
+        await run_in_db_thread(authenticate_token, request)
         return await handler(request, *args, **kwargs)
     return decorated
 
@@ -203,7 +548,7 @@ def user_authenticated(handler: Callable) -> Callable:
     @functools.wraps(handler)
     async def decorated(request: Request, *args: Any, **kwargs: Any) -> Any:
         """Authenticate the client on behalf of a user."""
-        authenticate_user(request)
+        await run_in_db_thread(authenticate_user, request)
         return await handler(request, *args, **kwargs)
     return decorated
 
@@ -213,7 +558,7 @@ def app_authenticated(handler: Callable) -> Callable:
     @functools.wraps(handler)
     async def decorated(request: Request, *args: Any, **kwargs: Any) -> Any:
         """Make sure the client is authenticated as an app."""
-        authenticate_token(request)
+        await run_in_db_thread(authenticate_token, request)
         if not isinstance(request.ctx.requester, App):
             raise Forbidden('Endpoint requires app authorisation.')
         return await handler(request, *args, **kwargs)
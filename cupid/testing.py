@@ -33,18 +33,33 @@ def enable():
     TESTING.coverage_measurer = coverage.Coverage(
         data_file=TESTING.coverage_file,
         source_pkgs=(
+            'cupid.autocomplete',
+            'cupid.cache',
+            'cupid.encoding',
+            'cupid.events',
             'cupid.graph',
+            'cupid.graph.components',
+            'cupid.graph.index',
+            'cupid.graph.search',
+            'cupid.graph.sql',
+            'cupid.notifications',
+            'cupid.principals',
             'cupid.tokens',
             'cupid.models',
             'cupid.models.app',
             'cupid.models.database',
             'cupid.models.enums',
+            'cupid.models.graph_change',
+            'cupid.models.migrations',
             'cupid.models.relationship',
+            'cupid.models.revocation',
             'cupid.models.session',
             'cupid.models.user',
             'cupid.routes',
             'cupid.routes.auth',
+            'cupid.routes.events',
             'cupid.routes.relationships',
+            'cupid.routes.stats',
             'cupid.routes.users',
             'cupid.routes.utils',
         ),
@@ -4,9 +4,14 @@ from __future__ import annotations
 import base64
 import dataclasses
 import enum
-from typing import Any
+import hashlib
+import hmac
+import threading
+from datetime import datetime, timezone
+from typing import Any, Optional
 
 from . import models
+from .config import CONFIG
 
 
 class TokenParseError(ValueError):
@@ -20,12 +25,94 @@ class TokenType(enum.Enum):
     SESSION = 1
 
 
+def _to_microseconds(time: Optional[datetime]) -> int:
+    """Convert a time to an integer timestamp, or 0 for no time."""
+    return round(time.timestamp() * 1_000_000) if time else 0
+
+
+def _from_microseconds(timestamp: int) -> Optional[datetime]:
+    """Convert an integer timestamp to a naive local time, or None for 0."""
+    if not timestamp:
+        return None
+    time = datetime.fromtimestamp(timestamp / 1_000_000, tz=timezone.utc)
+    return time.astimezone().replace(tzinfo=None)
+
+
+def _add_revocation(
+        revoked: dict[tuple[TokenType, int], datetime],
+        type: TokenType,
+        id: int,
+        revoked_at: datetime):
+    """Record a revocation, keeping only the latest for each entity."""
+    if (latest := revoked.get((type, id))) is None or latest < revoked_at:
+        revoked[type, id] = revoked_at
+
+
+class Revocations:
+    """The times before which signed tokens for each entity are rejected.
+
+    This is a copy of the revocation table, which is reloaded regularly so
+    that tokens can be checked without a database query. Revocations made
+    by this process are applied immediately, and those made by others once
+    the list is next reloaded.
+    """
+
+    def __init__(self):
+        """Create an empty revocation list."""
+        self.revoked: dict[tuple[TokenType, int], datetime] = {}
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        """Reload the revocation list from the database.
+
+        Session tokens expire anyway, so revocations older than a session
+        can last are skipped.
+        """
+        started = models.now()
+        oldest = started - CONFIG.session_expiry
+        query = models.Revocation.select().where(
+            (models.Revocation.token_type == TokenType.APP.value)
+            | (models.Revocation.revoked_at > oldest),
+        )
+        revoked = {}
+        for revocation in query:
+            _add_revocation(
+                revoked,
+                TokenType(revocation.token_type),
+                revocation.entity_id,
+                revocation.revoked_at,
+            )
+        with self.lock:
+            # Keep any made by this process while the query was running.
+            for (type, id), revoked_at in self.revoked.items():
+                if revoked_at >= started:
+                    _add_revocation(revoked, type, id, revoked_at)
+            self.revoked = revoked
+
+    def revoke(self, type: TokenType, id: int):
+        """Reject every signed token issued so far for an app or session."""
+        revocation = models.Revocation.create(
+            token_type=type.value, entity_id=id,
+        )
+        with self.lock:
+            _add_revocation(self.revoked, type, id, revocation.revoked_at)
+
+    def is_revoked(
+            self, type: TokenType, id: int, issued_at: datetime) -> bool:
+        """Check if a signed token was issued before it was revoked."""
+        revoked_at = self.revoked.get((type, id))
+        return revoked_at is not None and issued_at < revoked_at
+
+
+REVOCATIONS = Revocations()
+
+
 @dataclasses.dataclass
 class Token:
     """An authentication token.
 
     The first byte of a token (once decoded from base 64) indicates the token
-    version. Currently, only version 0 is defined.
+    version. Versions 0 and 1 are defined.
 
     In token version 0, the next byte indicates whether it is an app token
     (0), or a session token (1). The 4 bytes after that are a big endian
@@ -36,6 +123,14 @@ class Token:
 
     00 01 00 00 02 6a 86 bc fd 6a e7 fb 46 1f 31 44 40 52 cb 1a 5f 2c
 
+    Token version 1 starts with the same type and ID fields, followed by
+    the times the token was issued and expires at (0 for never), each as a
+    big endian 8 byte count of microseconds since the Unix epoch. The last
+    32 bytes are an HMAC-SHA256 signature of all the preceding bytes
+    (including the version), made with the server's token key. These can be
+    verified without a database query, and are only issued if a token key
+    is configured.
+
     Tokens will be encoded in a base 64 format (using '-' and '_' instead of
     '+' and '/', and no '=' padding).
     """
@@ -43,7 +138,10 @@ class Token:
     version: int
     type: TokenType
     id: int
-    secret: bytes
+    secret: bytes = b''
+    issued_at: Optional[datetime] = None
+    expires_at: Optional[datetime] = None
+    signature: bytes = b''
 
     @classmethod
     def from_entity(cls, entity: Any) -> Token:
@@ -54,7 +152,21 @@ class Token:
             type = TokenType.SESSION
         else:    # pragma: no cover
             raise TypeError('Entity must be an app or session object.')
-        return cls(version=0, type=type, id=entity.id, secret=entity.secret)
+        if not CONFIG.token_key:
+            return cls(
+                version=0, type=type, id=entity.id, secret=entity.secret,
+            )
+        token = cls(
+            version=1,
+            type=type,
+            id=entity.id,
+            issued_at=models.now(),
+            expires_at=(
+                entity.expires_at if type == TokenType.SESSION else None
+            ),
+        )
+        token.signature = token.sign()
+        return token
 
     @classmethod
     def from_token(cls, token: str) -> Token:
@@ -67,6 +179,8 @@ class Token:
         version = data[0]
         if version == 0:
             return cls.parse_version_0(data[1:])
+        if version == 1:
+            return cls.parse_version_1(data[1:])
         raise TokenParseError('Unkown token version.')
 
     @classmethod
@@ -83,10 +197,39 @@ class Token:
         secret = data[5:]
         return cls(version=0, type=type, id=id, secret=secret)
 
+    @classmethod
+    def parse_version_1(cls, data: bytes) -> Token:
+        """Parse version 1 token data."""
+        if len(data) != 53:
+            raise TokenParseError('Token does not contain all fields.')
+        try:
+            type = TokenType(data[0])
+        except ValueError as e:
+            raise TokenParseError('Invalid token type.') from e
+        try:
+            issued_at = _from_microseconds(int.from_bytes(data[5:13], 'big'))
+            expires_at = _from_microseconds(
+                int.from_bytes(data[13:21], 'big'),
+            )
+        except (OverflowError, OSError, ValueError) as e:
+            raise TokenParseError('Invalid token timestamp.') from e
+        if not issued_at:
+            raise TokenParseError('Invalid token timestamp.')
+        return cls(
+            version=1,
+            type=type,
+            id=int.from_bytes(data[1:5], 'big'),
+            issued_at=issued_at,
+            expires_at=expires_at,
+            signature=data[21:],
+        )
+
     def __str__(self) -> str:
         """Create the token from its fields."""
         if self.version == 0:
             data = self.serialise_version_0()
+        elif self.version == 1:
+            data = [*self.serialise_version_1(), *bytearray(self.signature)]
         else:    # pragma: no cover
             raise ValueError('Unkown token version.')
         data = bytes([self.version, *data])
@@ -100,13 +243,49 @@ class Token:
             *bytearray(self.secret),
         ]
 
+    def serialise_version_1(self) -> list[int]:
+        """Serialise a version 1 token, except for the signature."""
+        return [
+            self.type.value,
+            *self.id.to_bytes(4, 'big'),
+            *_to_microseconds(self.issued_at).to_bytes(8, 'big'),
+            *_to_microseconds(self.expires_at).to_bytes(8, 'big'),
+        ]
+
+    def sign(self) -> bytes:
+        """Create the signature of a version 1 token."""
+        return hmac.digest(
+            CONFIG.token_key.encode(),
+            bytes([self.version, *self.serialise_version_1()]),
+            hashlib.sha256,
+        )
+
     def to_entity(self) -> Any:
         """Get the app or session for this token."""
         model = models.App if self.type == TokenType.APP else models.Session
+        if self.version == 1:
+            return self.verify_version_1(model)
         entity = model.get_or_none(
             model.id == self.id,
             model.secret == self.secret,
         )
         if not entity:
             raise TokenParseError('ID or secret is incorrect.')
+        if self.type == TokenType.SESSION and entity.expired:
+            raise TokenParseError('Token has expired.')
         return entity
+
+    def verify_version_1(self, model: type) -> Any:
+        """Check a version 1 token without querying the database.
+
+        The app or session returned only has its ID loaded.
+        """
+        if not CONFIG.token_key:
+            raise TokenParseError('Signed tokens are not accepted.')
+        if not hmac.compare_digest(self.signature, self.sign()):
+            raise TokenParseError('Token signature is incorrect.')
+        if self.expires_at and self.expires_at <= models.now():
+            raise TokenParseError('Token has expired.')
+        if REVOCATIONS.is_revoked(self.type, self.id, self.issued_at):
+            raise TokenParseError('Token has been revoked.')
+        return model(id=self.id, __no_default__=True)